@@ -0,0 +1,315 @@
+# file to store functions to analyse cop data files for GetCOPparams.py
+# Each data file is analysed independently (load, resample, filter, cop
+# parameters) so the files of a study can be shared between a pool of worker
+# processes. Each worker analyses its files in batches with the batch
+# functions of COPparamsFs. Results are returned in the order the files are
+# given.
+
+import os
+import pickle
+import hashlib
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import COPparamsFs as cp
+import COPspectral as cs
+from WiiCopIO import load_cop
+
+# version of the analysis. Part of the key of cached results, so it must be
+# increased when a change to the analysis changes its results
+ANALYSIS_VERSION = 1
+# maximum number of data files analysed in one batch
+BATCH_MAX = 256
+
+# function to analyse one data file
+def analyse_file(params, task):
+    # params: dictionary of analysis parameters: 'cutoff' (proportion of
+    # Nyquist) or 'cutoff_hz' (Hz, None to use 'cutoff') and 'order' of the
+    # Butterworth filter, 'metrics', list of cop parameters (see
+    # COPparamsFs.METRICS and COPspectral.SPECTRAL), 'resamp_hz', sample
+    # rate to resample to or None to keep the number of samples and 'plot_f',
+    # True to return the cop for plotting
+    # task: dictionary with the 'path' of the data file (csv, binary or
+    # pickled), 'cal_mod' (see WiiCopIO.load_cop) and 'acq_time', the
+    # acquisition time in seconds or None for manual acquisitions, in which
+    # case the length of the recording is used
+    # returns dictionary of cop parameters, with the sample rate before
+    # resampling ('src_hz') if resampled to a fixed rate
+    return analyse_batch(params, [task])[0]
+
+# function to get the number of samples of cop data after resampling
+def n_resamp(cop_dat, resamp_hz=None):
+    # resamp_hz: fixed sample rate, None to keep the number of samples
+    n = cop_dat.shape[0]
+    if n < 2 or resamp_hz is None:
+        return n
+    span = np.max(cop_dat[:,2]) - np.min(cop_dat[:,2])
+    return int(np.floor(span*resamp_hz + 1e-9)) + 1
+
+# function to analyse a batch of data files
+def analyse_batch(params, tasks):
+    # as analyse_file for each of tasks, with all the files resampled,
+    # filtered and measured together. Files too short to filter (e.g. of
+    # aborted acquisitions) get NaN cop parameters and a warning
+    # returns list of dictionaries of cop parameters
+    cops = [load_cop(task['path'], task['cal_mod']) for task in tasks]
+    min_n = cp.filt_min_samp(params['order'], sos=params.get('cutoff_hz') is not None)
+    ok = []
+    for task, cop in zip(tasks, cops):
+        n = n_resamp(cop, params.get('resamp_hz'))
+        if n >= min_n:
+            ok.append(True)
+        else:
+            print('Not analysing {}: too few samples ({}) to filter'.format(task['path'], n))
+            ok.append(False)
+    ress = []
+    if any(ok):
+        ress = iter(analyse_cops(params, [task for task, f in zip(tasks, ok) if f],
+            [cop for cop, f in zip(cops, ok) if f]))
+    out = []
+    for cop, f in zip(cops, ok):
+        if f:
+            out.append(next(ress))
+            continue
+        res = {name:np.nan for name in params['metrics']}
+        if params.get('resamp_hz') is not None:
+            res['src_hz'] = np.nan
+        if params['plot_f']:
+            res['cop'] = cop[:,(0,1)]
+        out.append(res)
+    return out
+
+# function to analyse the cop data of a batch of data files
+def analyse_cops(params, tasks, cops):
+    # cops: list of cop data of each of tasks, long enough to filter
+    # returns list of dictionaries of cop parameters, see analyse_file
+    cop_dat, offs = cp.pack(cops)
+    # Preprocess COP data
+    # resample to even sample points, at a fixed rate if given
+    offs_r = offs
+    if params.get('resamp_hz') is None:
+        cop_dat_r = cp.resamp_batch(cop_dat, offs)
+    else:
+        cop_dat_r, offs_r, src_hz = cp.resamp_rate_batch(cop_dat, params['resamp_hz'], offs)
+    # low pass filtering
+    if params.get('cutoff_hz') is None:
+        cop_dat_f = cp.bfilt_batch(cop_dat_r, params['cutoff'], params['order'], offs_r)
+    else:
+        cop_dat_f = cp.sosfilt_batch(cop_dat_r, params['cutoff_hz'], params['order'], offs_r)
+    # Get COP parameters of filtered data. Path parameters (path length,
+    # velocities) are measured from the data before resampling and filtering
+    acq_time = [np.nan if task['acq_time'] is None else task['acq_time'] for task in tasks]
+    mets = cp.metrics_batch(cop_dat_f, [name for name in params['metrics'] if name in cp.METRICS],
+        offs_r, acq_time, path_dat=cop_dat, path_offs=offs)
+    # spectral parameters of resampled data
+    spec = [name for name in params['metrics'] if name in cs.SPECTRAL]
+    if spec:
+        mets.update(cs.spectral_batch(cop_dat_r, spec, offs_r))
+    ress = []
+    for i_t in range(len(tasks)):
+        res = {name:mets[name][i_t] for name in params['metrics']}
+        if params.get('resamp_hz') is not None:
+            res['src_hz'] = src_hz[i_t]
+        if params['plot_f']:
+            res['cop'] = cop_dat[offs[i_t]:offs[i_t+1],(0,1)]
+        ress.append(res)
+    return ress
+
+# function to analyse data files in a pool of worker processes
+def analyse_files(tasks, params, n_workers=None, chunksize=None):
+    # tasks: list of tasks, see analyse_file
+    # params: analysis parameters, see analyse_file
+    # n_workers: number of worker processes, None for one per cpu, 1 to
+    # analyse in this process
+    # chunksize: number of tasks analysed as a batch (see analyse_batch), None
+    # to split the tasks into about 4 chunks per worker of at most BATCH_MAX
+    # yields results of analyse_file in the order of tasks, each as soon as
+    # its chunk and those before it are done
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(tasks)))
+    if chunksize is None:
+        chunksize = min(BATCH_MAX, max(1, len(tasks)//(4*n_workers)))
+    chunks = [tasks[i:i+chunksize] for i in range(0, len(tasks), chunksize)]
+    # workers are forked as GetCOPparams.py isn't safe to import, so without
+    # fork (e.g. on windows) the files are analysed in this process
+    if n_workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for chunk in chunks:
+            yield from analyse_batch(params, chunk)
+        return
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(n_workers, mp_context=ctx) as pool:
+        for ress in pool.map(partial(analyse_batch, params), chunks):
+            yield from ress
+
+
+# function to analyse data files, reusing cached results of unchanged files
+def analyse_cached(tasks, params, cache, n_workers=None):
+    # cache: resultcache the results of new or changed files are added to.
+    # Call cache.save() once all results have been used
+    # see analyse_files for other parameters
+    # yields results of analyse_file in the order of tasks. The cop of
+    # cached files is read (without analysing it) if params['plot_f']
+    cached = [cache.get(params, task) for task in tasks]
+    todo = [task for task, res in zip(tasks, cached) if res is None]
+    new = analyse_files(todo, params, n_workers)
+    for task, res in zip(tasks, cached):
+        if res is None:
+            res = next(new)
+            cache.put(params, task, res)
+        elif params['plot_f']:
+            res = dict(res, cop=load_cop(task['path'], task['cal_mod'])[:,(0,1)])
+        yield res
+
+# function to get the sha1 hash of the content of a file
+def file_hash(fpath, block=1<<20):
+    sha = hashlib.sha1()
+    with open(fpath, 'rb') as fptr:
+        for blk in iter(lambda: fptr.read(block), b''):
+            sha.update(blk)
+    return sha.hexdigest()
+
+
+# class to store results of analysed data files between runs
+class resultcache:
+    'results of analyse_file kept in a file and reused while a data file and the analysis are unchanged'
+
+    # fpath: path of cache file, e.g. in the study results directory
+    # root: directory that data file paths are stored relative to, so the
+    # study can be moved
+    # hash_f: if True a data file whose modification time has changed but
+    # whose content (sha1 hash) hasn't, e.g. after being copied, is unchanged
+    def __init__(self, fpath, root, hash_f=False):
+        self.fpath = fpath
+        self.root = root
+        self.hash_f = hash_f
+        self.entries = {}
+        if os.path.isfile(fpath):
+            try:
+                with open(fpath, 'rb') as fptr:
+                    self.entries = pickle.load(fptr)
+            except (pickle.UnpicklingError, EOFError):
+                print('Ignoring unreadable analysis cache {}'.format(fpath))
+        # entries used in this run. Only these are saved so entries of
+        # deleted files don't build up
+        self.used = {}
+        self.n_hits = 0
+
+    def key(self, params, task):
+        # returns hash of the analysis version, analysis parameters (except
+        # plotting) and the task parameters the result depends on
+        cal_mod = task['cal_mod']
+        if cal_mod is not None:
+            cal_mod = np.asarray(cal_mod, dtype=float).tobytes()
+        prm = sorted((k, v) for k, v in params.items() if k != 'plot_f')
+        return hashlib.sha1(repr((ANALYSIS_VERSION, prm, cal_mod, task['acq_time'])).encode()).hexdigest()
+
+    def get(self, params, task):
+        # returns cached result of task or None if the data file is new or
+        # has changed or the analysis has changed
+        rel = os.path.relpath(task['path'], self.root)
+        ent = self.entries.get(rel)
+        if ent is None or ent['key'] != self.key(params, task):
+            return None
+        st = os.stat(task['path'])
+        if ent['size'] != st.st_size:
+            return None
+        if ent['mtime'] != st.st_mtime_ns:
+            if not self.hash_f or ent['hash'] != file_hash(task['path']):
+                return None
+            ent['mtime'] = st.st_mtime_ns
+        self.used[rel] = ent
+        self.n_hits += 1
+        return ent['result']
+
+    def put(self, params, task, res):
+        # store result res of task, without the cop kept for plotting
+        st = os.stat(task['path'])
+        ent = {'key':self.key(params, task), 'size':st.st_size, 'mtime':st.st_mtime_ns,
+            'hash':file_hash(task['path']) if self.hash_f else None,
+            'result':{k:v for k, v in res.items() if k != 'cop'}}
+        self.used[os.path.relpath(task['path'], self.root)] = ent
+
+    def save(self):
+        # write the entries used in this run to the cache file
+        with open(self.fpath + '.part', 'wb') as fptr:
+            pickle.dump(self.used, fptr)
+        os.replace(self.fpath + '.part', self.fpath)
+        self.entries = self.used
+
+
+# class to accumulate rows of results column by column
+class resultsbuilder:
+    'table of results appended a row at a time to column lists and made into one DataFrame'
+
+    # columns: list of column names
+    # dtypes: dictionary of numpy dtypes of columns, other columns are
+    # objects. Missing values of float columns are NaN
+    # csv_path: optional csv file that rows are written to every chunk_rows
+    # rows and when closed, so a large study isn't held in memory
+    def __init__(self, columns, dtypes=None, csv_path=None, chunk_rows=10000):
+        self.columns = list(columns)
+        self.dtypes = dtypes or {}
+        self.cols = {col:[] for col in self.columns}
+        self.csv_path = csv_path
+        self.chunk_rows = chunk_rows
+        # number of rows held and number already written to csv_path
+        self.n = 0
+        self.n_written = 0
+
+    def append(self, row):
+        # row: dictionary of column name to value. Columns not in row are
+        # missing values
+        for col in row:
+            if col not in self.cols:
+                raise KeyError('{} is not a results column'.format(col))
+        for col, vals in self.cols.items():
+            vals.append(row.get(col))
+        self.n += 1
+        if self.csv_path is not None and self.n >= self.chunk_rows:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def merge(self, other):
+        # add the rows held by another resultsbuilder, e.g. one filled by a
+        # worker process
+        for col, vals in self.cols.items():
+            vals.extend(other.cols.get(col, [None]*other.n))
+        self.n += other.n
+        if self.csv_path is not None and self.n >= self.chunk_rows:
+            self.flush()
+
+    def column(self, col):
+        # returns values of column col held as a numpy array of its dtype
+        dt = np.dtype(self.dtypes.get(col, object))
+        vals = self.cols[col]
+        if dt.kind == 'f':
+            vals = [np.nan if v is None else v for v in vals]
+        return np.array(vals, dtype=dt)
+
+    def to_frame(self):
+        # returns DataFrame of rows held. The index continues from the rows
+        # already written to csv_path
+        import pandas as pd
+        return pd.DataFrame({col:self.column(col) for col in self.columns}, columns=self.columns,
+            index=pd.RangeIndex(self.n_written, self.n_written+self.n))
+
+    def flush(self):
+        # write rows held to csv_path (with a header if the first rows) and
+        # clear them
+        if self.csv_path is None or (self.n == 0 and self.n_written > 0):
+            return
+        first = self.n_written == 0
+        self.to_frame().to_csv(self.csv_path, mode='w' if first else 'a', header=first)
+        self.n_written += self.n
+        for vals in self.cols.values():
+            vals.clear()
+        self.n = 0
+
+    def close(self):
+        # write remaining rows to csv_path
+        self.flush()
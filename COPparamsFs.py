@@ -1,10 +1,13 @@
 # file to store functions that calculate COP parameters
 # All functions need to input a cop data file, being a numpy array with 3
 # columns: x-data, y-data, time (seconds)
+# The batch functions at the end take many trials at once (see BATCHES)
 
 # IMPORTS
+import functools
 import numpy as np
 from scipy import signal
+from scipy import stats
 from scipy.interpolate import interp1d
 # Assumes hyperellipsoid.py is in same directory. Written by 'Marcos Duarte.
 # https://github.com/demotu/BMC'
@@ -62,3 +65,274 @@ def pathl(cop_dat):
     sum_s = np.add(sqs[:,0],sqs[:,1])
     lgths = np.sqrt(sum_s)
     return np.sum(lgths)
+
+
+# BATCHES
+# The batch functions process many trials in a few numpy calls. Trials are
+# either packed one after another into one N X 3 array, with an array 'offs'
+# of the row each trial starts at and N at the end (see pack), or trials of
+# equal length stacked in an n_trials X n_samp X 3 array, with offs None.
+# Each trial needs at least 2 samples (and enough for filtfilt to filter).
+# Batch results are the same as those of the functions above for each trial.
+
+def pack(trials):
+    # packs a list of cop data arrays into one array
+    # returns packed array and offsets
+    offs = np.zeros(len(trials)+1, dtype=np.intp)
+    np.cumsum([trial.shape[0] for trial in trials], out=offs[1:])
+    return np.concatenate(trials, axis=0), offs
+
+def unpack(cop_dat, offs):
+    # returns list of views of each trial of a packed array
+    return [cop_dat[offs[i]:offs[i+1]] for i in range(len(offs)-1)]
+
+def as_packed(cop_dat, offs=None):
+    # returns packed array and offsets of packed trials or a 3-D stack
+    if cop_dat.ndim == 3:
+        n_trl, n_smp = cop_dat.shape[0:2]
+        return cop_dat.reshape(n_trl*n_smp, -1), np.arange(n_trl+1)*n_smp
+    return cop_dat, np.asarray(offs)
+
+def interp_batch(cop_dat, offs, t_new, offs_new):
+    # linearly interpolate x and y of each packed trial, with times increasing,
+    # at times t_new of the same trial (packed with offsets offs_new)
+    # returns len(t_new) X 3 array
+    lens = np.diff(offs)
+    lens_new = np.diff(offs_new)
+    t = cop_dat[:,2]
+    t0 = t[offs[:-1]]
+    span = t[offs[1:]-1] - t0
+    # shift the times of each trial to follow on from the previous trial
+    # after a gap of a second, so all trials are interpolated in one call
+    start = np.zeros(lens.size)
+    np.cumsum(span[:-1]+1, out=start[1:])
+    t_sh = t - np.repeat(t0 - start, lens)
+    # keep new times inside their trial despite rounding
+    lo = np.repeat(start, lens_new)
+    hi = np.repeat(start+span, lens_new)
+    t_new_sh = np.clip(t_new - np.repeat(t0, lens_new) + lo, lo, hi)
+    out = np.empty((t_new.size, 3))
+    out[:,0] = np.interp(t_new_sh, t_sh, cop_dat[:,0])
+    out[:,1] = np.interp(t_new_sh, t_sh, cop_dat[:,1])
+    out[:,2] = t_new
+    return out
+
+def resamp_batch(cop_dat, offs=None):
+    # resample each trial to even sample points using same average sample
+    # rate. Returns array of the same shape as cop_dat
+    pk, offs = as_packed(cop_dat, offs)
+    lens = np.diff(offs)
+    t0 = pk[offs[:-1],2]
+    span = pk[offs[1:]-1,2] - t0
+    # even sample points of each trial as np.linspace
+    k = np.arange(pk.shape[0]) - np.repeat(offs[:-1], lens)
+    t_new = np.repeat(span/(lens-1), lens)*k
+    t_new[offs[1:]-1] = span
+    t_new += np.repeat(t0, lens)
+    out = interp_batch(pk, offs, t_new, offs)
+    return out.reshape(cop_dat.shape[0:-1] + (3,))
+
+def resamp_rate_batch(cop_dat, fs, offs=None):
+    # resample each trial to a fixed sample rate fs (Hz), from its first
+    # sample to its last. Samples are sorted by time first and samples with
+    # the same time are averaged
+    # returns packed resampled trials, their offsets and array of the sample
+    # rate of each trial before resampling (unique times per second)
+    pk, offs = as_packed(cop_dat, offs)
+    lens = np.diff(offs)
+    trl = np.repeat(np.arange(lens.size), lens)
+    # sort by time within each trial
+    srt = np.lexsort((pk[:,2], trl))
+    pk = pk[srt]
+    # average samples with the same time
+    new = np.ones(pk.shape[0], dtype=bool)
+    new[1:] = (pk[1:,2] != pk[:-1,2]) | (trl[1:] != trl[:-1])
+    grp = np.cumsum(new) - 1
+    cnt = np.bincount(grp)
+    src = np.empty((cnt.size, 3))
+    src[:,0] = np.bincount(grp, pk[:,0])/cnt
+    src[:,1] = np.bincount(grp, pk[:,1])/cnt
+    src[:,2] = pk[new,2]
+    offs_src = np.searchsorted(trl[new], np.arange(lens.size+1))
+    lens_src = np.diff(offs_src)
+    t0 = src[offs_src[:-1],2]
+    span = src[offs_src[1:]-1,2] - t0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        src_fs = (lens_src - 1)/span
+    # even sample points of each trial at fs
+    lens_new = np.floor(span*fs + 1e-9).astype(np.intp) + 1
+    offs_new = np.zeros(lens.size+1, dtype=np.intp)
+    np.cumsum(lens_new, out=offs_new[1:])
+    k = np.arange(offs_new[-1]) - np.repeat(offs_new[:-1], lens_new)
+    t_new = k/fs + np.repeat(t0, lens_new)
+    return interp_batch(src, offs_src, t_new, offs_new), offs_new, src_fs
+
+def resamp_rate(cop_dat, fs):
+    # resample data to fixed sample rate fs (Hz), see resamp_rate_batch
+    # returns resampled data and sample rate before resampling
+    out, offs, src_fs = resamp_rate_batch(cop_dat, fs, np.array([0, cop_dat.shape[0]]))
+    return out, src_fs[0]
+
+def bfilt_batch(cop_dat, cutoff, order, offs=None):
+    # Butterworth filter each trial. Returns array of the same shape as
+    # cop_dat
+    b,a = signal.butter(order, cutoff)
+    out = np.array(cop_dat, dtype=float)
+    if cop_dat.ndim == 3:
+        out[:,:,0:2] = signal.filtfilt(b, a, out[:,:,0:2], axis=1)
+        return out
+    offs = np.asarray(offs)
+    lens = np.diff(offs)
+    # trials of the same length are filtered together as a stack
+    for n in np.unique(lens):
+        idx = offs[:-1][lens == n,np.newaxis] + np.arange(n)
+        out[idx,0:2] = signal.filtfilt(b, a, out[idx,0:2], axis=1)
+    return out
+
+@functools.lru_cache(maxsize=64)
+def filt_design(fs, cutoff, order, btype='low'):
+    # returns second order sections of a Butterworth filter with cutoff in Hz
+    # (a tuple of low and high for 'bandpass' or 'bandstop') at sample rate
+    # fs (Hz). Designs are kept for reuse
+    return signal.butter(order, cutoff, btype=btype, fs=fs, output='sos')
+
+def sosfilt_batch(cop_dat, cutoff, order, offs=None, btype='low'):
+    # zero phase Butterworth filter of each evenly sampled trial with cutoff
+    # in Hz (see filt_design) at the trial's own sample rate. Returns array of
+    # the same shape as cop_dat
+    out = np.array(cop_dat, dtype=float)
+    pk, offs = as_packed(out, offs)
+    lens = np.diff(offs)
+    # sample rates to a microhertz, so trials resampled to the same rate
+    # share a design
+    fs = np.round((lens - 1)/(pk[offs[1:]-1,2] - pk[offs[:-1],2]), 6)
+    # trials of the same length and rate are filtered together as a stack
+    for n, fsi in sorted(set(zip(lens.tolist(), fs.tolist()))):
+        sel = (lens == n) & (fs == fsi)
+        idx = offs[:-1][sel,np.newaxis] + np.arange(n)
+        pk[idx,0:2] = signal.sosfiltfilt(filt_design(fsi, cutoff, order, btype), pk[idx,0:2], axis=1)
+    return out
+
+def sosfilt(cop_dat, cutoff, order, btype='low'):
+    # zero phase Butterworth filter of one evenly sampled trial with cutoff
+    # in Hz, see sosfilt_batch
+    return sosfilt_batch(cop_dat, cutoff, order, np.array([0, cop_dat.shape[0]]), btype)
+
+# names of the cop parameters metrics_batch calculates. x is the coronal
+# (medio-lateral, ml) axis and y the sagittal (antero-posterior, ap) axis
+METRICS = ('pred_ellipse','path_length','velocity','rms_ml','rms_ap','range_ml','range_ap',
+    'mean_vel_ml','mean_vel_ap','mean_dist','sway_area','ellipse_major','ellipse_minor',
+    'ellipse_angle')
+# parameters measured from the steps between samples
+PATH_METRICS = ('path_length','velocity','mean_vel_ml','mean_vel_ap')
+
+def metrics_batch(cop_dat, names, offs=None, acq_time=None, path_dat=None, path_offs=None):
+    # calculates the cop parameters in names (see METRICS) of each trial in
+    # one pass, sharing the steps, centred data and covariance between them
+    # acq_time: array of acquisition time of each trial in seconds that
+    # velocities and sway area are per, None (or NaN) for the trial length
+    # path_dat: cop data to measure the path parameters (PATH_METRICS) from,
+    # e.g. before filtering, None to use cop_dat
+    # path_offs: offsets of path_dat if it has different lengths of trials to
+    # cop_dat (e.g. before resampling to a fixed rate), None for offs
+    # returns dictionary of name to array of values of each trial
+    #   pred_ellipse: area of 95% prediction ellipse (as PI95)
+    #   path_length: length of cop path (as pathl)
+    #   velocity: path length per second
+    #   rms_ml, rms_ap: root mean square distance from mean cop on each axis
+    #   range_ml, range_ap: range of cop on each axis
+    #   mean_vel_ml, mean_vel_ap: mean velocity along each axis
+    #   mean_dist: mean distance from mean cop
+    #   sway_area: area swept by the line from mean cop to cop per second
+    #   ellipse_major, ellipse_minor: semi-axes of 95% prediction ellipse
+    #   ellipse_angle: angle of major axis from x axis in degrees (-90 to 90)
+    for name in names:
+        if name not in METRICS:
+            raise ValueError('{} is not a cop parameter'.format(name))
+    need = set(names)
+    pk, offs = as_packed(cop_dat, offs)
+    st = offs[:-1]
+    n = np.diff(offs)
+    if acq_time is None:
+        acq_time = np.full(n.size, np.nan)
+    acq_time = np.asarray(acq_time, dtype=float)
+    acq_time = np.where(np.isnan(acq_time), pk[offs[1:]-1,2] - pk[st,2], acq_time)
+    res = {}
+    # steps between samples, without those from one trial to the next
+    if need.intersection(PATH_METRICS):
+        ppk, poffs = pk, offs
+        if path_dat is not None:
+            ppk, poffs = as_packed(path_dat, offs if path_offs is None else path_offs)
+        delt = np.zeros((ppk.shape[0],2))
+        delt[:-1] = np.diff(ppk[:,0:2], axis=0)
+        delt[poffs[1:]-1] = 0
+        if 'path_length' in need or 'velocity' in need:
+            pl = np.add.reduceat(np.sqrt(np.square(delt[:,0]) + np.square(delt[:,1])), poffs[:-1])
+            res['path_length'] = pl
+            res['velocity'] = pl/acq_time
+        if 'mean_vel_ml' in need or 'mean_vel_ap' in need:
+            vel = np.add.reduceat(np.abs(delt), poffs[:-1], axis=0)/acq_time[:,np.newaxis]
+            res['mean_vel_ml'] = vel[:,0]
+            res['mean_vel_ap'] = vel[:,1]
+    if 'range_ml' in need or 'range_ap' in need:
+        rng = np.maximum.reduceat(pk[:,0:2], st, axis=0) - np.minimum.reduceat(pk[:,0:2], st, axis=0)
+        res['range_ml'] = rng[:,0]
+        res['range_ap'] = rng[:,1]
+    # centred data and covariance
+    if need.difference(PATH_METRICS, ('range_ml','range_ap')):
+        mn = np.add.reduceat(pk[:,0:2], st, axis=0)/n[:,np.newaxis]
+        dev = pk[:,0:2] - np.repeat(mn, n, axis=0)
+        sq = np.square(dev)
+        sums = np.add.reduceat(sq, st, axis=0)
+        res['rms_ml'] = np.sqrt(sums[:,0]/n)
+        res['rms_ap'] = np.sqrt(sums[:,1]/n)
+        if 'mean_dist' in need:
+            res['mean_dist'] = np.add.reduceat(np.sqrt(sq[:,0] + sq[:,1]), st)/n
+        if 'sway_area' in need:
+            # twice the area of the triangle between mean cop and
+            # consecutive samples
+            tri = np.zeros(pk.shape[0])
+            tri[:-1] = np.abs(dev[:-1,0]*dev[1:,1] - dev[1:,0]*dev[:-1,1])
+            tri[offs[1:]-1] = 0
+            res['sway_area'] = np.add.reduceat(tri, st)/(2*acq_time)
+        # covariance matrix (as np.cov) and its eigenvalues
+        cxx = sums[:,0]/(n-1)
+        cyy = sums[:,1]/(n-1)
+        cxy = np.add.reduceat(dev[:,0]*dev[:,1], st)/(n-1)
+        half_tr = (cxx + cyy)/2
+        disc = np.sqrt(np.square((cxx - cyy)/2) + np.square(cxy))
+        # as hyperellipsoid for 2 dimensions: the semi-axes are the square
+        # roots of the eigenvalues scaled by an F quantile
+        fppf = stats.f.ppf(0.95, 2, n-2)*(n-1)*2*(n+1)/n/(n-2)
+        res['pred_ellipse'] = np.pi*fppf*np.sqrt(cxx*cyy - np.square(cxy))
+        res['ellipse_major'] = np.sqrt((half_tr + disc)*fppf)
+        res['ellipse_minor'] = np.sqrt(np.maximum(half_tr - disc, 0)*fppf)
+        res['ellipse_angle'] = np.rad2deg(np.arctan2(2*cxy, cxx - cyy)/2)
+    return {name:res[name] for name in names}
+
+def metrics(cop_dat, names, acq_time=None, path_dat=None):
+    # returns dictionary of cop parameters in names of one trial, see
+    # metrics_batch
+    offs = np.array([0, cop_dat.shape[0]])
+    if acq_time is not None:
+        acq_time = [acq_time]
+    res = metrics_batch(cop_dat, names, offs, acq_time, path_dat)
+    return {name:val[0] for name, val in res.items()}
+
+def filt_min_samp(order, btype='low', sos=False):
+    # returns the fewest samples a trial needs to be filtered by bfilt_batch
+    # (or sosfilt_batch if sos), as filtfilt pads each end of the trial
+    if sos:
+        wn = (0.25, 0.5) if btype in ('bandpass','bandstop') else 0.5
+        sec = signal.butter(order, wn, btype=btype, output='sos')
+        edge = 2*len(sec) + 1 - min(np.sum(sec[:,2] == 0), np.sum(sec[:,5] == 0))
+        return 3*edge + 1
+    return 3*(order+1) + 1
+
+def pathl_batch(cop_dat, offs=None):
+    # returns array of COP path length of each trial
+    return metrics_batch(cop_dat, ['path_length'], offs)['path_length']
+
+def PI95_batch(cop_dat, offs=None):
+    # returns array of area of 95% prediction ellipse of each trial
+    return metrics_batch(cop_dat, ['pred_ellipse'], offs)['pred_ellipse']
@@ -0,0 +1,122 @@
+# file to store functions that calculate spectral COP parameters
+# Power spectral densities (PSD) of the cop on each axis are estimated with
+# Welch's method, as scipy.signal.welch with its defaults (Hann window, 50%
+# overlap, mean of each segment removed), from evenly resampled cop data (see
+# COPparamsFs.resamp). Trials are packed or stacked as for the batch
+# functions of COPparamsFs. Trials of the same length are transformed in one
+# FFT call, and windows and frequency grids are reused between calls.
+
+# IMPORTS
+import functools
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# number of samples per Welch segment (all samples of shorter trials). About
+# 15s at the usual sample rate, so low frequency sway is resolved
+NPERSEG = 1024
+# frequency range (Hz) of mean and 95% power frequency (Prieto, T.E., Myklebust,
+# J.B., Hoffmann, R.G., Lovett, E.G. and Myklebust, B.M., 1996. Measures of
+# postural steadiness: differences between healthy young and elderly adults.
+# IEEE Transactions on biomedical engineering, 43(9), pp.956-966.)
+FREQ_RANGE = (0.15, 5)
+# frequency bands (Hz) of band powers
+BANDS = {'bp_low':(0.15, 0.5), 'bp_mid':(0.5, 2), 'bp_high':(2, 5)}
+# names of the spectral cop parameters, each of the coronal (ml, x) and
+# sagittal (ap, y) axis:
+#   mpf: mean power frequency
+#   f95: frequency below which is 95% of the power
+#   bp_low, bp_mid, bp_high: power in each of BANDS (mm^2)
+SPECTRAL = tuple('{}_{}'.format(name, ax) for name in ('mpf','f95') + tuple(BANDS)
+    for ax in ('ml','ap'))
+
+@functools.lru_cache(maxsize=32)
+def seg_plan(n_samp):
+    # returns samples per segment, step between segments, Hann window and
+    # sum of squares of window for trials of n_samp samples
+    nperseg = min(NPERSEG, n_samp)
+    step = nperseg - nperseg//2
+    # periodic Hann window as scipy.signal.get_window('hann', nperseg)
+    win = 0.5 - 0.5*np.cos(2*np.pi*np.arange(nperseg)/nperseg)
+    win.setflags(write=False)
+    return nperseg, step, win, np.sum(np.square(win))
+
+@functools.lru_cache(maxsize=256)
+def freq_grid(n_samp, fs):
+    # returns frequencies (Hz) of the PSD of a trial of n_samp samples at
+    # sample rate fs
+    frq = np.fft.rfftfreq(seg_plan(n_samp)[0], 1/fs)
+    frq.setflags(write=False)
+    return frq
+
+def welch_stack(cop_dat):
+    # Welch PSD of x and y of each trial of an n_trials X n_samp X 3 stack of
+    # evenly sampled trials
+    # returns n_trials X n_freq array of frequencies and n_trials X 2 X n_freq
+    # array of PSD (mm^2/Hz)
+    n_trl, n_samp = cop_dat.shape[0:2]
+    nperseg, step, win, wsum = seg_plan(n_samp)
+    xy = np.moveaxis(cop_dat[:,:,0:2], 1, 2)
+    # n_trials X 2 X n_segments X nperseg view of overlapping segments
+    segs = sliding_window_view(xy, nperseg, axis=2)[:,:,::step]
+    segs = (segs - np.mean(segs, axis=3, keepdims=True))*win
+    psd = np.mean(np.square(np.abs(np.fft.rfft(segs, axis=3))), axis=2)
+    # one-sided density: double all but the zero (and Nyquist) frequency
+    if nperseg % 2:
+        psd[:,:,1:] *= 2
+    else:
+        psd[:,:,1:-1] *= 2
+    fs = (n_samp - 1)/(cop_dat[:,-1,2] - cop_dat[:,0,2])
+    psd /= (fs*wsum)[:,np.newaxis,np.newaxis]
+    frqs = np.stack([freq_grid(n_samp, fsi) for fsi in fs])
+    return frqs, psd
+
+def spectral_stack(cop_dat, names):
+    # returns dictionary of spectral cop parameters in names (see SPECTRAL)
+    # of each trial of a stack of evenly sampled trials
+    frqs, psd = welch_stack(cop_dat)
+    df = frqs[:,1,np.newaxis] - frqs[:,0,np.newaxis]
+    res = {}
+    # power in frequency range and its mean and 95% frequency
+    rng = (frqs >= FREQ_RANGE[0]) & (frqs <= FREQ_RANGE[1])
+    pwr = psd*rng[:,np.newaxis,:]
+    tot = np.sum(pwr, axis=2)
+    mpf = np.sum(pwr*frqs[:,np.newaxis,:], axis=2)/tot
+    i95 = np.sum(np.cumsum(pwr, axis=2) < 0.95*tot[:,:,np.newaxis], axis=2)
+    i95 = np.minimum(i95, frqs.shape[1] - 1)
+    f95 = np.take_along_axis(frqs, i95, axis=1)
+    for i_ax, ax in enumerate(('ml','ap')):
+        res['mpf_'+ax] = mpf[:,i_ax]
+        res['f95_'+ax] = f95[:,i_ax]
+    for band, (lo, hi) in BANDS.items():
+        bnd = (frqs >= lo) & (frqs < hi)
+        bp = np.sum(psd*bnd[:,np.newaxis,:], axis=2)*df
+        res[band+'_ml'] = bp[:,0]
+        res[band+'_ap'] = bp[:,1]
+    return {name:res[name] for name in names}
+
+def spectral_batch(cop_dat, names, offs=None):
+    # calculates the spectral cop parameters in names (see SPECTRAL) of each
+    # of the evenly sampled trials of cop_dat (packed with offsets offs, or a
+    # stack)
+    # returns dictionary of name to array of values of each trial
+    for name in names:
+        if name not in SPECTRAL:
+            raise ValueError('{} is not a spectral cop parameter'.format(name))
+    if cop_dat.ndim == 3:
+        return spectral_stack(cop_dat, names)
+    offs = np.asarray(offs)
+    lens = np.diff(offs)
+    res = {name:np.empty(lens.size) for name in names}
+    # trials of the same length are transformed together as a stack
+    for n in np.unique(lens):
+        sel = lens == n
+        idx = offs[:-1][sel,np.newaxis] + np.arange(n)
+        for name, val in spectral_stack(cop_dat[idx], names).items():
+            res[name][sel] = val
+    return res
+
+def spectral(cop_dat, names):
+    # returns dictionary of spectral cop parameters in names of one evenly
+    # sampled trial, see spectral_batch
+    res = spectral_stack(cop_dat[np.newaxis], names)
+    return {name:val[0] for name, val in res.items()}
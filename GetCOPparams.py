@@ -8,12 +8,11 @@ import sys
 import os
 import re
 import pickle
-import numpy as np
-import pandas as pd
 import configparser
-import matplotlib.pyplot as plt
-import matplotlib
-import COPparamsFs as cp
+from WiiCopIO import read_timing
+# scipy (via COPanalysis), pandas (when results are written) and matplotlib
+# are imported once the study has been chosen, so the first dialog opens
+# quickly
 # %matplotlib inline
 #import pdb; pdb.set_trace()
 
@@ -21,9 +20,15 @@ import COPparamsFs as cp
 # INITIALISE
 # set regular expression to find calibration file
 cal_re = "calib.*dat"
-# set regular expression to find cop data file
-cop_re = "subj.*.dat"
-# specify list of cop parameters
+# set regular expression to find cop data file (pickled, binary wiicop or csv)
+cop_re = r"subj.*\.(dat|wcop|csv)$"
+# set regular expression to find board label in file names of sessions with
+# more than one board
+bb_re = "_bb[0-9]+"
+# specify list of cop parameters (see COPparamsFs.METRICS and
+# COPspectral.SPECTRAL). A study config
+# file can give its own list in an [analysis] section, e.g.
+#   cop_params = pred_ellipse,path_length,velocity,rms_ml,rms_ap
 cop_params = ['pred_ellipse','path_length','velocity']
 # string that signifies subject code
 sbjstr = 'subj'
@@ -42,24 +47,71 @@ BB_X = 433
 # filter parameters...
 # cutoff frequency as proportion of Nyquist
 cutoff = 2/3
+# cutoff frequency in Hz, used instead of cutoff if not None. Each file is
+# filtered at its own sample rate (the same for all with resamp_hz)
+cutoff_hz = None
 # order of Butterworth filter
 order = 4
+# sample rate (Hz) to resample data files to before filtering, e.g. 50 or
+# 100, so the filter cutoff is the same in Hz for every file. The sample rate
+# of each file before resampling is added to the results (src_hz). None to
+# resample to even sample points keeping the number of samples
+resamp_hz = None
+# Recalibrate flag. If True the cop of data files is recalculated from their
+# raw sensor readings using the calibration model in the session
+# directory's calibration file (which can be replaced with a corrected one)
+# instead of the model stored in each file
+recal_f = False
+# number of worker processes to analyse data files with, None for one per
+# cpu or 1 to analyse them one at a time in this process
+n_workers = None
+# timing quality limits. Data files whose timing sidecar (written by
+# wiicop.py) shows an effective sample rate below min_rate (Hz) or a gap
+# between samples longer than max_gap (milliseconds) are skipped. None for
+# no limit. Files without a sidecar are always kept
+min_rate = None
+max_gap = None
+# timing quality columns added to the study results
+timing_cols = ['eff_hz','max_gap_ms','n_ioerror','zero_pcnt']
+if resamp_hz is not None:
+    timing_cols = timing_cols + ['src_hz']
+# number of rows of study results written to file at a time
+csv_chunk = 5000
+# cache flag. If True the results of each data file are stored in the results
+# directory and reused in the next run if the file and analysis parameters
+# are unchanged, so only new or changed files are analysed
+cache_f = True
+# if True a data file with a new modification time but the same content
+# (e.g. copied from a backup) counts as unchanged. Slower as each new or
+# changed file is read to hash it
+cache_hash = False
 
 # set up if plots flagged
 if disps_f or saves_f:
-    matplotlib.rcParams['toolbar'] = 'None'
     # create empty list to store stuff to plot
     plt_lst = []
-    # create figure and axis
-    fig,ax = plt.subplots(1)
-    fig.canvas.set_window_title('Stabilogram')
 
 # setup regular expression objects
 cal_re_o = re.compile(cal_re)
 cop_re_o = re.compile(cop_re)
+bb_re_o = re.compile(bb_re)
+
+# function to check timing quality of a data file against min_rate and max_gap
+def timing_ok(timing):
+    # timing: dictionary from read_timing or None
+    if timing is None:
+        return True
+    if min_rate is not None and timing['effective_hz'] < min_rate:
+        return False
+    if max_gap is not None and timing['max_gap_ms'] > max_gap:
+        return False
+    return True
+
+# function to get board label from file name ('' if only one board)
+def bb_lbl(fn):
+    mtch = bb_re_o.search(fn)
+    return mtch.group(0) if mtch else ''
 
-# create empty pandas dataframes to store calibration and cop data
-cal_df=pd.DataFrame(columns=['session','sensor','slope','slope.se','r.coef','p-val'])
 # change to $XDG_RUNTIME_DIR/gvfs where samba mounts its shares
 # gvfs_pth = os.environ['XDG_RUNTIME_DIR']+'/gvfs/'
 # os.chdir(os.path.dirname(gvfs_pth))
@@ -73,7 +125,9 @@ config = configparser.ConfigParser()
 config.read(config_file)
 # get info list of factors
 fct_lst = config.options('factors')
-cop_df=pd.DataFrame(columns=['session','subj'] + fct_lst + cop_params)
+# get list of cop parameters if the study has its own
+if config.has_option('analysis','cop_params'):
+    cop_params = [prm.strip() for prm in config['analysis']['cop_params'].split(',')]
 
 
 # SEARCH THROUGH CHOSEN DIRECTORY STRUCTURE
@@ -81,127 +135,155 @@ cop_df=pd.DataFrame(columns=['session','subj'] + fct_lst + cop_params)
 seshd = tk_fd.askdirectory(title = 'Open study directory containing sessions')
 if not seshd:
     sys.exit()
+
+# import analysis modules now study has been chosen
+import COPanalysis
+from COPparamsFs import METRICS
+from COPspectral import SPECTRAL
+bad_params = [prm for prm in cop_params if prm not in METRICS + SPECTRAL]
+if bad_params:
+    print('Unknown cop parameters {}. Choose from {}'.format(', '.join(bad_params),
+        ', '.join(METRICS + SPECTRAL)))
+    sys.exit(1)
+# create results directory if it doesn't exist
+res_dir = os.path.join(seshd,'results')
+if not(os.path.isdir(res_dir)):
+    os.mkdir(res_dir)
+# create results tables for calibration and cop data. Study results are
+# written to file every csv_chunk rows
+cal_cols = ['session','board','sensor','slope','slope.se','r.coef','p-val']
+cal_res = COPanalysis.resultsbuilder(cal_cols, dtypes={col:float for col in cal_cols[3:]},
+    csv_path=os.path.join(res_dir,'calib_results.csv'))
+cop_res = COPanalysis.resultsbuilder(['session','subj','board'] + fct_lst + cop_params + timing_cols,
+    dtypes={col:float for col in cop_params + timing_cols},
+    csv_path=os.path.join(res_dir,'study_results.csv'), chunk_rows=csv_chunk)
+# data files to analyse and their study metadata, found before analysis
+tasks = []
+meta_rows = []
 for root, dirs, files in os.walk(seshd):
+    # walk in sorted order so results are in the same order each run
+    dirs.sort()
+    files.sort()
     # for each directory
     if len(files) > 0:
+        # calibration models for session keyed by board label
+        sesh_cal_mods = {}
 
-        # look for calibration file using reg expression
+        # look for calibration files using reg expression
         c_lst = list(filter(cal_re_o.match,files))
-        if c_lst:
-            # if list c_lst is not empty..
-            # should contain only one calibration file
-            assert len(c_lst)==1, "more than one calibration file in directory: {}".format(root)
+        for c_fn in c_lst:
+            # one calibration file per board
             # open calibration file
-            c_pth = os.path.join(root,c_lst[0])
+            c_pth = os.path.join(root,c_fn)
             with open(c_pth,'rb') as fptr:
                 tmp = pickle.load(fptr, fix_imports=False)
 
-            # Store 1 row of calibration data...
+            sesh_cal_mods[bb_lbl(c_fn)] = tmp['model']
+            # Store 1 row of calibration data for each sensor...
             cal_dat = tmp['details']
-            nxt_cal = len(cal_df.index)
-            s_ind = 0
             for sns in cal_dat.keys():
-                # for each sensor..
-                # create empty row
-                cal_df.loc[nxt_cal+s_ind] = None
-                cal_df.ix[nxt_cal+s_ind,'session'] = os.path.basename(root)
-                cal_df.ix[nxt_cal+s_ind,'sensor'] = sns
-                cal_df.ix[nxt_cal+s_ind,'slope'] = cal_dat[sns]['m']
-                cal_df.ix[nxt_cal+s_ind,'slope.se'] = cal_dat[sns]['se']
-                cal_df.ix[nxt_cal+s_ind,'r.coef'] = cal_dat[sns]['r']
-                cal_df.ix[nxt_cal+s_ind,'p-val'] = cal_dat[sns]['p']
-                s_ind+=1
+                cal_res.append({'session':os.path.basename(root), 'board':bb_lbl(c_fn).lstrip('_'),
+                    'sensor':sns, 'slope':cal_dat[sns]['m'], 'slope.se':cal_dat[sns]['se'],
+                    'r.coef':cal_dat[sns]['r'], 'p-val':cal_dat[sns]['p']})
 
         # look for cop data file using reg expression
         d_lst = list(filter(cop_re_o.match,files))
-        if d_lst:
-            for fi in d_lst:
-                # for each data file..
-
-                # store row of study metadata...
-                nxt_cop = len(cop_df.index)
-                # create empty row
-                cop_df.loc[nxt_cop] = None
-                # strip extension
-                prts = fi.split('.')
-                # save levels as list
-                lev_lst = prts[0].split('_')
-                # get subject code
-                tmp = [s for s in lev_lst if sbjstr in s]
-                scode = tmp[0].strip(sbjstr)
-                # convert to int then back to string with 3 leading zeros
-                scode = int(scode)
-                scode = str(scode).zfill(3)
-                cop_df.ix[nxt_cop,'subj'] = scode
-                # get session
-                cop_df.ix[nxt_cop,'session'] = os.path.basename(root)
-                # read study metadata into df
-                for fct_i in fct_lst:
-                    for lev in lev_lst:
-                        if lev in config['factors'][fct_i]:
-                            cop_df.ix[nxt_cop,fct_i] = lev
-
-
-                # read COP data
-                d_pth = os.path.join(root,fi)
-                with open(d_pth,'rb') as fptr:
-                    pkl = pickle.load(fptr)
-                # convert time data into seconds
-                t_dat = pkl['timedat']
-                t_dat = t_dat[:,0] + t_dat[:,1]/1000000
-                # reshape t_dat so that it is an nd array with one singleton dimension
-                t_dat = np.reshape(t_dat,(t_dat.size,-1))
-                # add time data to cop data
-                cop_dat = np.concatenate((pkl['cop'],t_dat), axis=1)
-
-                # Preprocess COP data
-                # resample to even sample points
-                cop_dat_r = cp.resamp(cop_dat)
-                # low pass filtering
-                cop_dat_f = cp.bfilt(cop_dat_r, cutoff, order)
-                # # TEST ***
-                # # plot coronal
-                # fg, (ax1, ax2) = plt.subplots(1, 2, sharey=True)
-                # # resampled or raw
-                # ax1.plot(cop_dat[:,2],cop_dat[:,0],'bo-')
-                # # ax1.plot(t,cor,'bo-')
-                # ax1.set_xlabel('time (secs)')
-                # ax1.set_ylabel('coronal plane')
-                # ax1.set_title('Raw data')
-                # ax1.grid()
-                # # resampled and filtered
-                # ax2.plot(cop_dat_f[:,2],cop_dat_f[:,0],'bo-')
-                # ax2.set_xlabel('time (secs)')
-                # ax2.set_title('Resampled and filtered')
-                # ax2.grid()
-                # mng = plt.get_current_fig_manager()
-                # mng.resize(*mng.window.maxsize())
-                # plt.show()
-                # # ***
-
-                # Get COP parameters...
-                # 95% Prediction interval
-                cop_df.ix[nxt_cop,'pred_ellipse'] = cp.PI95(cop_dat_f)
-                # path length
-                pl = cp.pathl(cop_dat)
-                cop_df.ix[nxt_cop,'path_length'] = pl
-                # velocity
-                import pdb; pdb.set_trace()
-                cop_df.ix[nxt_cop,'velocity'] = pl/int(cop_df.ix[nxt_cop,'acq_time'])
-
-                # store data for plotting if flagged
-                if disps_f or saves_f:
-                    # create a dictionary of relevant study factors
-                    std_fct = {}
-                    std_fct['subj'] = scode
-                    for fct_i in fct_lst:
-                        for lev in lev_lst:
-                            if lev in config['factors'][fct_i]:
-                                std_fct[fct_i] = lev
-                    plt_lst.append([[cop_dat, std_fct]])
+        for fi in d_lst:
+            # for each data file..
+            d_pth = os.path.join(root,fi)
+            # check timing quality from sidecar without reading data
+            timing = read_timing(d_pth)
+            if not timing_ok(timing):
+                print('Skipping {}: {:.1f}Hz, max gap {:.1f}ms'.format(d_pth,
+                    timing['effective_hz'], timing['max_gap_ms']))
+                continue
+
+            # store study metadata...
+            meta = {}
+            # strip extension
+            prts = fi.split('.')
+            # save levels as list
+            lev_lst = prts[0].split('_')
+            # get subject code
+            tmp = [s for s in lev_lst if sbjstr in s]
+            scode = tmp[0].strip(sbjstr)
+            # convert to int then back to string with 3 leading zeros
+            scode = int(scode)
+            scode = str(scode).zfill(3)
+            meta['subj'] = scode
+            # get session
+            meta['session'] = os.path.basename(root)
+            # get board
+            meta['board'] = bb_lbl(fi).lstrip('_')
+            # read study metadata
+            for fct_i in fct_lst:
+                for lev in lev_lst:
+                    if lev in config['factors'][fct_i]:
+                        meta[fct_i] = lev
+            # acquisition time from 't<secs>' level of file name ('tmanual'
+            # if stopped by hand)
+            acq_time = None
+            for lev in lev_lst:
+                if lev[0] == 't' and lev[1:].isdigit():
+                    acq_time = int(lev[1:])
+                    if 'acq_time' in fct_lst:
+                        meta['acq_time'] = lev[1:]
+            # store timing quality
+            if timing is not None:
+                meta['eff_hz'] = timing['effective_hz']
+                meta['max_gap_ms'] = timing['max_gap_ms']
+                meta['n_ioerror'] = timing['n_ioerror']
+                if timing['n_samples'] > 0:
+                    meta['zero_pcnt'] = 100*max(timing['zero_counts'])/timing['n_samples']
+            meta_rows.append(meta)
+
+            # analysis task. Files are recalculated with the session's
+            # calibration if flagged
+            cal_mod = None
+            if recal_f:
+                cal_mod = sesh_cal_mods.get(bb_lbl(fi))
+            tasks.append({'path':d_pth, 'cal_mod':cal_mod, 'acq_time':acq_time})
+
+# ANALYSE DATA FILES
+# load, resample, filter and get cop parameters of each file in parallel
+print('Analysing {} data files...'.format(len(tasks)))
+params = {'cutoff':cutoff, 'cutoff_hz':cutoff_hz, 'order':order, 'metrics':cop_params, 'resamp_hz':resamp_hz,
+    'plot_f':disps_f or saves_f}
+if cache_f:
+    res_cache = COPanalysis.resultcache(os.path.join(res_dir,'analysis_cache'), seshd, cache_hash)
+    results = COPanalysis.analyse_cached(tasks, params, res_cache, n_workers)
+else:
+    results = COPanalysis.analyse_files(tasks, params, n_workers)
+for meta, res in zip(meta_rows, results):
+    # store row of study metadata and cop parameters
+    row = dict(meta)
+    for col in cop_params:
+        row[col] = res[col]
+    if resamp_hz is not None:
+        row['src_hz'] = res['src_hz']
+    cop_res.append(row)
+
+    # store data for plotting if flagged
+    if disps_f or saves_f:
+        # create a dictionary of relevant study factors
+        std_fct = {}
+        std_fct['subj'] = meta['subj']
+        for fct_i in fct_lst:
+            if fct_i in meta:
+                std_fct[fct_i] = meta[fct_i]
+        plt_lst.append([[res['cop'], std_fct]])
+if cache_f:
+    res_cache.save()
+    print('{} of {} results reused from cache'.format(res_cache.n_hits, len(tasks)))
 
 # Plot stabilograms (see Scoppa2013) if flagged
 if disps_f or saves_f:
+    import matplotlib
+    import matplotlib.pyplot as plt
+    matplotlib.rcParams['toolbar'] = 'None'
+    # create figure and axis
+    fig,ax = plt.subplots(1)
+    fig.canvas.set_window_title('Stabilogram')
     if saves_f:
         # create image directory if it doesn't exist in current working directory
         imdirpth = os.path.join(os.getcwd(),imdir)
@@ -238,13 +320,6 @@ if disps_f or saves_f:
         txt_h.remove()
 
 
-# create results directory if it doesn't exist
-res_dir = os.path.join(seshd,'results')
-if not(os.path.isdir(res_dir)):
-    os.mkdir(res_dir)
-# write calibration results
-calib_file = os.path.join(res_dir,'calib_results.csv')
-cal_df.to_csv(calib_file)
-# write study results
-study_file = os.path.join(res_dir,'study_results.csv')
-cop_df.to_csv(study_file)
+# write remaining calibration and study results
+cal_res.close()
+cop_res.close()
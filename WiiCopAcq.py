@@ -0,0 +1,726 @@
+# file to store acquisition classes for use by wiicop.py
+
+import os
+import time
+import errno
+import select
+import threading
+from queue import Queue
+import numpy as np
+from WiiCopIO import WCOP_DTYPE, wcop_header, write_timing
+from WiiCopFunctions import calcCOP, calcCOPbatch
+import WiiCopDevice
+
+# columns of acquisition buffer rows: event time secs, event time microsecs,
+# time on the monotonic time base shared by all boards (secs) and the raw
+# readings of the sensors from ROW_SENS on
+ROW_SEC = 0
+ROW_USEC = 1
+ROW_MONO = 2
+ROW_SENS = 3
+
+# counters at the start of the shared memory of wii_process: number of rows
+# written to the ring (sequence number of the next row), number of samples
+# stored and 1 once the worker has finished
+SHM_SEQ = 0
+SHM_STORED = 1
+SHM_DONE = 2
+SHM_N_CNT = 8
+# edges of the bins of the histogram of gaps between samples (milliseconds).
+# The last bin counts gaps longer than the last edge
+GAP_EDGES = (0, 5, 10, 15, 20, 30, 50, 100, 250, 1000)
+
+# class to store acquisition samples in preallocated chunks
+class sampbuffer:
+    'growable buffer of preallocated fixed-dtype chunks written to one row per sample'
+
+    # n_cols: number of values stored per sample
+    # dtype: numpy dtype of the stored values
+    # chunk_len: number of samples per preallocated chunk
+    # sink: optional callable sink(chunk, n_rows, recycle) that full chunks are
+    # handed to instead of being kept in memory (e.g. a chunkwriter). It must
+    # call recycle(chunk), if not None, once it has finished with the chunk
+    def __init__(self, n_cols, dtype=np.float64, chunk_len=4096, sink=None):
+        self.n_cols = n_cols
+        self.dtype = np.dtype(dtype)
+        self.chunk_len = chunk_len
+        # list of full chunks
+        self.chunks = []
+        # chunk currently being filled and index of its next free row
+        self.cur = np.empty((chunk_len, n_cols), dtype=self.dtype)
+        self.i_row = 0
+        # total number of samples stored
+        self.n = 0
+        self.sink = sink
+        # chunks returned by the sink for reuse
+        self.free = []
+
+    def put(self, row):
+        # write one sample into the next free row. Only allocates when a
+        # chunk is full, i.e. once every chunk_len samples
+        self.cur[self.i_row] = row
+        self.i_row += 1
+        self.n += 1
+        if self.i_row == self.chunk_len:
+            if self.sink is None:
+                self.chunks.append(self.cur)
+            else:
+                self.sink(self.cur, self.chunk_len, self.recycle)
+            self.cur = self.new_chunk()
+            self.i_row = 0
+
+    def new_chunk(self):
+        # returns a recycled chunk if one is available, otherwise a new one
+        if self.free:
+            return self.free.pop()
+        return np.empty((self.chunk_len, self.n_cols), dtype=self.dtype)
+
+    def recycle(self, chunk):
+        # called by the sink to give back a chunk it has finished with
+        self.free.append(chunk)
+
+    def flush(self):
+        # hand the partly filled current chunk to the sink
+        if self.sink is not None and self.i_row > 0:
+            self.sink(self.cur, self.i_row, None)
+            self.cur = self.new_chunk()
+            self.i_row = 0
+
+
+# class to keep timing quality statistics of an acquisition
+class timingstats:
+    'streaming statistics of the event times and sensor readings of stored samples'
+
+    # n_s: number of sensors
+    # gap_edges: edges of gap histogram bins in milliseconds
+    def __init__(self, n_s=4, gap_edges=GAP_EDGES):
+        self.gap_edges = np.array(gap_edges, dtype=float)
+        self.gap_hist = np.zeros(self.gap_edges.size, dtype=np.int64)
+        self.n = 0
+        self.t_first = None
+        self.t_last = None
+        # longest gap between samples (milliseconds)
+        self.max_gap = 0.0
+        # number of dispatches while storing that found no event, and that
+        # failed with any other error
+        self.n_eagain = 0
+        self.n_ioerr = 0
+        # number of zero readings of each sensor
+        self.zero_cnt = np.zeros(n_s, dtype=np.int64)
+
+    def add_rows(self, rows):
+        # update with a chunk of acquisition buffer rows
+        if rows.shape[0] == 0:
+            return
+        t = rows[:,ROW_SEC] + rows[:,ROW_USEC]/1000000
+        if self.t_last is None:
+            self.t_first = t[0]
+            gaps = np.diff(t)*1000
+        else:
+            gaps = np.diff(t, prepend=self.t_last)*1000
+        if gaps.size > 0:
+            self.max_gap = max(self.max_gap, float(gaps.max()))
+            # gaps below the first edge (clock steps back) go in the first bin
+            i_bin = np.searchsorted(self.gap_edges, gaps, side='right') - 1
+            np.clip(i_bin, 0, None, out=i_bin)
+            self.gap_hist += np.bincount(i_bin, minlength=self.gap_hist.size)
+        self.zero_cnt += np.count_nonzero(rows[:,ROW_SENS:] == 0, axis=0)
+        self.n += t.size
+        self.t_last = t[-1]
+
+    def count_error(self, err):
+        # count a failed dispatch with errno err
+        if err == errno.EAGAIN:
+            self.n_eagain += 1
+        else:
+            self.n_ioerr += 1
+
+    def result(self):
+        # returns dictionary of statistics
+        dur = self.t_last - self.t_first if self.n > 1 else 0.0
+        return {'n_samples':self.n, 'duration':dur,
+            'effective_hz':(self.n - 1)/dur if dur > 0 else 0.0,
+            'max_gap_ms':self.max_gap, 'gap_edges_ms':self.gap_edges.tolist(),
+            'gap_hist':self.gap_hist.tolist(), 'n_eagain':self.n_eagain,
+            'n_ioerror':self.n_ioerr, 'zero_counts':self.zero_cnt.tolist()}
+
+
+# class to write acquisition chunks to file while recording is in progress
+class chunkwriter(threading.Thread):
+    'background thread that appends chunks of samples to a session file'
+
+    # mode to open file in
+    fmode = 'w'
+
+    # fpath: path of the file to write. Data is written to fpath+'.part' and
+    # renamed to fpath when the writer is closed
+    # cal_mod, BB_X, BB_Y: calibration model and board size used to
+    # calculate the cop of each chunk, see calcCOPbatch
+    # max_chunks: maximum number of chunks waiting to be written. If the
+    # writer falls this far behind the acquisition thread will wait for it
+    def __init__(self, fpath, cal_mod, BB_X, BB_Y, max_chunks=16):
+        threading.Thread.__init__(self)
+        self.fpath = fpath
+        self.cal_mod = cal_mod
+        self.BB_X = BB_X
+        self.BB_Y = BB_Y
+        # arrays reused to calculate cop and load of each chunk
+        self.cop_buf = np.empty((0,2))
+        self.load_buf = np.empty(0)
+        self.part_path = fpath + '.part'
+        self.chunk_q = Queue(maxsize=max_chunks)
+        # time of first sample in seconds
+        self.t0 = None
+        # number of samples written
+        self.n = 0
+        # timing quality of the samples written, saved next to the file
+        self.stats = timingstats()
+
+    def __call__(self, chunk, n_rows, recycle):
+        # queue chunk for writing. Used as the sink of a sampbuffer
+        self.chunk_q.put((chunk, n_rows, recycle))
+
+    def run(self):
+        with open(self.part_path, self.fmode) as fptr:
+            self.write_head(fptr)
+            while True:
+                item = self.chunk_q.get()
+                if item is None:
+                    break
+                chunk, n_rows, recycle = item
+                self.stats.add_rows(chunk[:n_rows])
+                self.write_rows(fptr, chunk[:n_rows])
+                self.n += n_rows
+                if recycle is not None:
+                    recycle(chunk)
+                # make samples so far visible on disk in case of a crash
+                fptr.flush()
+            os.fsync(fptr.fileno())
+        # finalize atomically
+        os.replace(self.part_path, self.fpath)
+        write_timing(self.fpath, self.stats.result())
+
+    def calc_cop(self, rows):
+        # returns cop of a chunk of acquisition buffer rows, calculated in
+        # one pass
+        n = rows.shape[0]
+        if self.cop_buf.shape[0] < n:
+            self.cop_buf = np.empty((n,2))
+            self.load_buf = np.empty(n)
+        cop, load = calcCOPbatch(rows[:,ROW_SENS:], self.cal_mod, self.BB_X, self.BB_Y,
+            self.cop_buf[:n], self.load_buf[:n])
+        return cop
+
+    def write_head(self, fptr):
+        fptr.write('copx,copy,time,mtime,TopR,BotR,TopL,BotL\n')
+
+    def write_rows(self, fptr, rows):
+        # rows are acquisition buffer rows. Write cop x, cop y, time in secs
+        # since first sample, time on the shared monotonic time base (to
+        # align boards) and the raw sensor readings, so the cop can be
+        # recalculated with another calibration
+        t = rows[:,ROW_SEC] + rows[:,ROW_USEC]/1000000
+        if self.t0 is None and rows.shape[0] > 0:
+            self.t0 = t[0]
+        n_s = rows.shape[1] - ROW_SENS
+        out = np.empty((rows.shape[0], 4+n_s))
+        out[:,(0,1)] = self.calc_cop(rows)
+        out[:,2] = t - self.t0 if self.t0 is not None else t
+        out[:,3] = rows[:,ROW_MONO]
+        out[:,4:] = rows[:,ROW_SENS:]
+        np.savetxt(fptr, out, fmt=['%.6f']*4+['%d']*n_s, delimiter=',')
+
+    def close(self):
+        # write any queued chunks, finalize the file and wait for the thread
+        self.chunk_q.put(None)
+        self.join()
+
+
+# class to write acquisition chunks to a binary wiicop file
+class wcopwriter(chunkwriter):
+    'chunkwriter that writes the binary wiicop (.wcop) format'
+
+    fmode = 'wb'
+
+    # meta: dictionary of acquisition info stored in the file header. The
+    # calibration model and board size are added to it so the cop can be
+    # calculated when the file is read
+    # chunk_len: number of samples per chunk, used to preallocate records
+    def __init__(self, fpath, meta, cal_mod, BB_X, BB_Y, chunk_len=4096, max_chunks=16):
+        chunkwriter.__init__(self, fpath, cal_mod, BB_X, BB_Y, max_chunks)
+        self.meta = dict(meta, cal_mod=np.asarray(cal_mod).tolist(), BB_X=BB_X, BB_Y=BB_Y)
+        self.recs = np.empty(chunk_len, dtype=WCOP_DTYPE)
+
+    def write_head(self, fptr):
+        fptr.write(wcop_header(self.meta))
+
+    def write_rows(self, fptr, rows):
+        # rows are acquisition buffer rows. Only times and raw sensor
+        # readings are stored, the cop is calculated when the file is read
+        recs = self.recs[:rows.shape[0]]
+        recs['t_us'] = rows[:,ROW_SEC].astype(np.int64)*1000000 + rows[:,ROW_USEC].astype(np.int64)
+        recs['mono_us'] = np.round(rows[:,ROW_MONO]*1000000)
+        recs['sens'] = rows[:,ROW_SENS:]
+        fptr.write(recs.tobytes())
+
+
+# class with the state shared by the acquisition engines
+class acq_base:
+    'balance board device, sample buffer and latest sample of an acquisition engine'
+
+    # bb: balance board device from connectBB
+    # cal_mod: calibration model, see calcCOP
+    # BB_X, BB_Y: size of balance board in mm
+    # writer: sink that full chunks of samples are passed to (see sampbuffer)
+    # chunk_len: number of samples per chunk
+    # bknd: device backend, defaults to WiiCopDevice.get_backend()
+    # t_base: time.monotonic() value that is time zero of the time base shared
+    # by the engines of all boards. Defaults to when the engine is created
+    def init_acq(self,bb,cal_mod,BB_X,BB_Y,writer,chunk_len,bknd,t_base):
+        self.runflag = True
+        self.storeflag = False
+        self.n_s = 4
+        if bknd is None:
+            bknd = WiiCopDevice.get_backend()
+        self.bknd = bknd
+        # open bb device
+        self.bbdev = bknd.open(bb)
+        # create xwiimote event structure
+        self.revt = bknd.event()
+        if t_base is None:
+            t_base = time.monotonic()
+        self.t_base = t_base
+        # buffer to store rows of times and raw sensor readings (see ROW_SEC
+        # etc.). Full chunks are passed to writer, which calculates the cop
+        # of the whole chunk, to be saved during acquisition
+        self.acq_buf = sampbuffer(ROW_SENS+self.n_s, chunk_len=chunk_len, sink=writer)
+        # timing quality statistics, failed dispatches are counted here
+        self.stats = writer.stats
+        self.acq_row = np.zeros(ROW_SENS+self.n_s)
+        # latest raw sensor readings - a view of the sensor part of acq_row
+        self.tmp_dat = self.acq_row[np.newaxis,ROW_SENS:]
+        self.cal_mod = cal_mod
+        self.BB_X = BB_X
+        self.BB_Y = BB_Y
+
+    def read_event(self):
+        # dispatch the next event into acq_row. Raises IOError as dispatch
+        self.bbdev.dispatch(self.revt)
+        self.acq_row[ROW_SEC:ROW_USEC+1] = self.revt.get_time()
+        self.acq_row[ROW_MONO] = time.monotonic() - self.t_base
+        for i_s in range(self.n_s):
+            self.tmp_dat[0,i_s] = self.revt.get_abs(i_s)[0]
+
+    def read_error(self, e, count_f=True):
+        # handle IOError e raised by read_event. Counted in the timing stats
+        # if count_f, e.g. while samples are stored. Returns True if the board
+        # has gone (disconnected or end of replay) and acquiring should stop,
+        # False if there was no event ready (EAGAIN)
+        if count_f:
+            self.stats.count_error(e.errno)
+        # do nothing if resource unavailable
+        if e.errno == errno.EAGAIN:
+            return False
+        print(e)
+        return True
+
+    def latest_cop(self):
+        # returns cop of the latest sample. Only called for the samples that
+        # are displayed, so the cop isn't calculated for every event
+        return calcCOP(self.tmp_dat.copy(),self.cal_mod,self.BB_X,self.BB_Y)
+
+    def event_lag(self):
+        # returns seconds since the time of the latest event, 0 if none yet.
+        # A large lag means events are waiting to be dispatched
+        if self.acq_row[ROW_SEC] == 0:
+            return 0
+        return time.time() - (self.acq_row[ROW_SEC] + self.acq_row[ROW_USEC]/1000000)
+
+    def set_writer(self, writer):
+        # pass stored samples to the current writer and later ones to writer,
+        # so a new file can be started without closing the device. Must not
+        # be called while samples are being stored
+        self.acq_buf.flush()
+        self.acq_buf.sink = writer
+        self.stats = writer.stats
+
+
+# class to acquire data from the balance board, based on threading.thread
+class wii_thread(acq_base, threading.Thread):
+    'thread that reads balance board events and stores them while storeflag is set'
+
+    # see acq_base.init_acq for parameters
+    def __init__ (self,bb,cal_mod,BB_X,BB_Y,writer,chunk_len=4096,bknd=None,t_base=None):
+        threading.Thread.__init__(self)
+        # lock to protect flags shared with the display
+        self.lock = threading.Lock()
+        self.init_acq(bb,cal_mod,BB_X,BB_Y,writer,chunk_len,bknd,t_base)
+        self.p = select.poll()
+        self.p.register(self.bbdev.get_fd(), select.POLLIN)
+
+    def set_flags(self,storeflag,runflag):
+        # set flags from another thread, e.g. the display
+        self.lock.acquire()
+        self.storeflag = storeflag
+        self.runflag = runflag
+        self.lock.release()
+
+    def run(self):
+        lock = self.lock
+        lock.acquire()
+        runflag = self.runflag
+        lock.release()
+        while runflag:
+            polls = self.p.poll()
+            try:
+                self.read_event()
+                lock.acquire()
+                storeflag = self.storeflag
+                lock.release()
+                if storeflag:
+                    self.acq_buf.put(self.acq_row)
+            except IOError as e:
+                if self.read_error(e, self.storeflag):
+                    break
+            lock.acquire()
+            runflag = self.runflag
+            lock.release()
+        # pass remaining samples to writer
+        self.acq_buf.flush()
+        # close down BB interface
+        self.p.unregister(self.bbdev.get_fd())
+        self.bknd.close(self.bbdev)
+
+
+# class for a balance board kept open for a series of acquisitions
+class wii_board(acq_base):
+    'balance board read in the calling thread by acquire_for, kept open between acquisitions'
+
+    # see acq_base.init_acq for parameters. Use set_writer to change the
+    # file samples are written to between acquisitions
+    def __init__ (self,bb,cal_mod,BB_X,BB_Y,writer,chunk_len=4096,bknd=None,t_base=None):
+        self.init_acq(bb,cal_mod,BB_X,BB_Y,writer,chunk_len,bknd,t_base)
+
+    def drain(self, max_evts=100000):
+        # discard events that arrived while not acquiring, so the next
+        # acquisition starts with current samples. Stops at the first event
+        # from after drain was called. Raises IOError if the board has gone
+        t_now = time.time()
+        for i_evt in range(max_evts):
+            try:
+                self.read_event()
+            except IOError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if self.acq_row[ROW_SEC] + self.acq_row[ROW_USEC]/1000000 >= t_now:
+                return
+
+    def close(self):
+        # pass remaining samples to writer and close device
+        self.acq_buf.flush()
+        self.bknd.close(self.bbdev)
+
+
+# function to acquire from balance boards in the calling thread
+def acquire_for(boards, secs, status=None, status_secs=1):
+    # stores samples from each wii_board in boards for secs seconds and
+    # passes them to the boards' writers. status: optional function called
+    # with boards every status_secs, e.g. to print progress. Returns False if
+    # a board stopped (e.g. disconnected) before the end, otherwise True
+    p = select.poll()
+    fd_bds = {}
+    for bd in boards:
+        bd.drain()
+        fd = bd.bbdev.get_fd()
+        fd_bds[fd] = bd
+        p.register(fd, select.POLLIN)
+    t_now = time.monotonic()
+    t_end = t_now + secs
+    t_stat = t_now + status_secs
+    done_f = True
+    while done_f and t_now < t_end:
+        t_wake = min(t_end, t_stat) if status is not None else t_end
+        for fd, evt in p.poll(max(0, (t_wake - t_now)*1000)):
+            bd = fd_bds[fd]
+            try:
+                bd.read_event()
+                bd.acq_buf.put(bd.acq_row)
+            except IOError as e:
+                if bd.read_error(e):
+                    done_f = False
+        t_now = time.monotonic()
+        if status is not None and t_now >= t_stat:
+            status(boards)
+            t_stat += status_secs
+    for fd, bd in fd_bds.items():
+        p.unregister(fd)
+        bd.acq_buf.flush()
+    return done_f
+
+
+# class to run an asyncio event loop in a thread
+class asyncloop(threading.Thread):
+    'thread running an asyncio event loop shared by wii_async engines'
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        # imported here as it is slow to import and only this engine uses it
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        import asyncio
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+        self.loop.close()
+
+
+# class to acquire data from the balance board in an asyncio event loop
+class wii_async(acq_base):
+    'asyncio engine that reads balance board events when its file descriptor is readable'
+
+    # loop: asyncio event loop to run in, e.g. asyncloop().loop. Several
+    # engines (one per board) can share a loop
+    # max_drain: maximum number of events read per wakeup, so one board
+    # can't hold up the loop
+    # see acq_base.init_acq for other parameters
+    def __init__ (self,bb,cal_mod,BB_X,BB_Y,writer,loop,chunk_len=4096,bknd=None,t_base=None,
+        max_drain=256):
+        self.init_acq(bb,cal_mod,BB_X,BB_Y,writer,chunk_len,bknd,t_base)
+        self.loop = loop
+        self.max_drain = max_drain
+        # rows stored at the current wakeup, passed to samples() streams
+        self.drained = np.empty((max_drain, self.acq_row.size))
+        # queues of samples() streams
+        self.streams = []
+        # set when the engine has stopped
+        self.done = threading.Event()
+
+    def start(self):
+        # start reading events. Can be called from any thread
+        self.loop.call_soon_threadsafe(self.add_reader)
+
+    def add_reader(self):
+        self.loop.add_reader(self.bbdev.get_fd(), self.on_readable)
+
+    def set_flags(self,storeflag,runflag):
+        # set flags from any thread. They are changed in the loop between
+        # wakeups, so no lock is needed
+        self.loop.call_soon_threadsafe(self.apply_flags, storeflag, runflag)
+
+    def apply_flags(self,storeflag,runflag):
+        self.storeflag = storeflag
+        if self.runflag and not runflag:
+            self.stop()
+        self.runflag = runflag
+
+    def on_readable(self):
+        # read all pending events, up to max_drain
+        n_read = 0
+        n_drn = 0
+        end_f = False
+        try:
+            for i_evt in range(self.max_drain):
+                self.read_event()
+                n_read += 1
+                if self.storeflag:
+                    self.acq_buf.put(self.acq_row)
+                    self.drained[n_drn] = self.acq_row
+                    n_drn += 1
+        except IOError as e:
+            # EAGAIN ends every drain, so it is only a failed read if the
+            # wakeup found no event at all
+            count_f = self.storeflag and (n_read == 0 or e.errno != errno.EAGAIN)
+            end_f = self.read_error(e, count_f)
+        if n_drn > 0:
+            for strm in self.streams:
+                strm.put_nowait(self.drained[:n_drn].copy())
+        if end_f:
+            self.runflag = False
+            self.stop()
+
+    def stop(self):
+        # stop reading events, pass remaining samples to writer and close
+        # device. Called in the loop
+        if self.done.is_set():
+            return
+        self.loop.remove_reader(self.bbdev.get_fd())
+        self.acq_buf.flush()
+        self.bknd.close(self.bbdev)
+        for strm in self.streams:
+            strm.put_nowait(None)
+        self.done.set()
+
+    def join(self, timeout=None):
+        # wait until the engine has stopped. Must not be called in the loop
+        self.done.wait(timeout)
+
+    async def samples(self):
+        # async stream of arrays of the samples stored at each wakeup, rows
+        # as in the acquisition buffer. Ends when the engine stops
+        import asyncio
+        strm = asyncio.Queue()
+        self.streams.append(strm)
+        try:
+            while not self.done.is_set() or not strm.empty():
+                rows = await strm.get()
+                if rows is None:
+                    break
+                yield rows
+        finally:
+            self.streams.remove(strm)
+
+
+# class to acquire data from the balance board in a separate process
+class wii_process(acq_base):
+    'engine that reads the balance board in a worker process, sharing the latest samples through shared memory'
+
+    # control channel ends of all engines in this process. Each worker closes
+    # the others' ends it inherits, so it sees EOF once the display has gone
+    pipes = []
+
+    # the worker is forked so the board, backend and writer don't need to be
+    # pickled. writer must not be started: it runs in the worker, which
+    # closes it when acquisition ends
+    # n_ring: number of latest rows kept in the shared memory ring
+    # see acq_base.init_acq for other parameters
+    def __init__ (self,bb,cal_mod,BB_X,BB_Y,writer,chunk_len=4096,bknd=None,t_base=None,
+        n_ring=256):
+        self.bb = bb
+        self.writer = writer
+        self.chunk_len = chunk_len
+        self.bknd = bknd
+        if t_base is None:
+            t_base = time.monotonic()
+        self.t_base = t_base
+        self.n_s = 4
+        self.cal_mod = cal_mod
+        self.BB_X = BB_X
+        self.BB_Y = BB_Y
+        self.n_ring = n_ring
+        n_cols = ROW_SENS+self.n_s
+        # imported here so the other engines start without them
+        import multiprocessing
+        from multiprocessing import shared_memory
+        # shared memory holds the counters then a ring of the latest rows
+        self.shm = shared_memory.SharedMemory(create=True, size=8*(SHM_N_CNT+n_ring*n_cols))
+        self.cnt = np.ndarray(SHM_N_CNT, dtype=np.int64, buffer=self.shm.buf)
+        self.cnt[:] = 0
+        self.ring = np.ndarray((n_ring, n_cols), buffer=self.shm.buf, offset=8*SHM_N_CNT)
+        # latest row read from the ring, see acq_base
+        self.acq_row = np.zeros(n_cols)
+        self.tmp_dat = self.acq_row[np.newaxis,ROW_SENS:]
+        # control channel: (storeflag, runflag) tuples sent to the worker
+        self.ctrl, self.ctrl_w = multiprocessing.Pipe(duplex=False)
+        wii_process.pipes.append((self.ctrl, self.ctrl_w))
+        # pid of the display process, checked by the worker in case the
+        # pipe isn't closed
+        self.ppid = os.getpid()
+        ctx = multiprocessing.get_context('fork')
+        self.proc = ctx.Process(target=self.run_worker)
+
+    def start(self):
+        self.proc.start()
+        # worker's end of the control channel
+        self.ctrl.close()
+
+    def set_flags(self,storeflag,runflag):
+        # send flags to the worker
+        try:
+            self.ctrl_w.send((storeflag, runflag))
+        except OSError:
+            # worker has already stopped
+            pass
+
+    def run_worker(self):
+        # acquisition loop of the worker process
+        for ctrl, ctrl_w in wii_process.pipes:
+            if ctrl is not self.ctrl:
+                ctrl.close()
+            ctrl_w.close()
+        self.writer.start()
+        self.init_acq(self.bb,self.cal_mod,self.BB_X,self.BB_Y,self.writer,self.chunk_len,
+            self.bknd,self.t_base)
+        dev_fd = self.bbdev.get_fd()
+        p = select.poll()
+        p.register(dev_fd, select.POLLIN)
+        p.register(self.ctrl.fileno(), select.POLLIN)
+        cnt = self.cnt
+        ring = self.ring
+        while self.runflag:
+            polls = p.poll(1000)
+            if not polls and os.getppid() != self.ppid:
+                # display process has gone
+                self.runflag = False
+            # control messages first, so flags sent before an event apply to it
+            for fd, evt in sorted(polls, key=lambda fd_evt: fd_evt[0] == dev_fd):
+                if fd != dev_fd:
+                    try:
+                        self.storeflag, self.runflag = self.ctrl.recv()
+                    except EOFError:
+                        # display process has gone
+                        self.runflag = False
+                    continue
+                try:
+                    self.read_event()
+                except IOError as e:
+                    if self.read_error(e, self.storeflag):
+                        self.runflag = False
+                    continue
+                # write row then advance sequence number, so the display
+                # never reads a row that is being written
+                seq = cnt[SHM_SEQ]
+                ring[seq % self.n_ring] = self.acq_row
+                cnt[SHM_SEQ] = seq + 1
+                if self.storeflag:
+                    self.acq_buf.put(self.acq_row)
+                    cnt[SHM_STORED] += 1
+        self.acq_buf.flush()
+        p.unregister(dev_fd)
+        self.bknd.close(self.bbdev)
+        self.writer.close()
+        cnt[SHM_DONE] = 1
+
+    def read_latest(self):
+        # copy latest row of the ring into acq_row. The copy is retried if
+        # the worker has gone round the ring while it was being read
+        for i_try in range(3):
+            seq = self.cnt[SHM_SEQ]
+            if seq == 0:
+                return
+            self.acq_row[:] = self.ring[(seq - 1) % self.n_ring]
+            if self.cnt[SHM_SEQ] - seq < self.n_ring - 1:
+                return
+
+    def latest_cop(self):
+        self.read_latest()
+        return acq_base.latest_cop(self)
+
+    def event_lag(self):
+        self.read_latest()
+        return acq_base.event_lag(self)
+
+    @property
+    def n_stored(self):
+        # number of samples stored by the worker
+        return int(self.cnt[SHM_STORED])
+
+    def join(self, timeout=None):
+        # wait for the worker to finish and free the shared memory
+        self.proc.join(timeout)
+        if self.proc.exitcode is None:
+            return
+        self.read_latest()
+        self.ctrl_w.close()
+        if (self.ctrl, self.ctrl_w) in wii_process.pipes:
+            wii_process.pipes.remove((self.ctrl, self.ctrl_w))
+        # keep a copy of the counters once the shared memory is gone
+        self.cnt = self.cnt.copy()
+        self.ring = None
+        self.shm.close()
+        self.shm.unlink()
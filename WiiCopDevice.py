@@ -0,0 +1,227 @@
+# file to store balance board device backends for use by wiicop.py
+#
+# A backend finds balance boards and opens them. The opened device and event
+# objects have the same interface as those of the xwiimote bindings:
+#   dev.get_fd()       file descriptor to poll for events
+#   dev.dispatch(evt)  fill evt with the next event, IOError(EAGAIN) if none
+#   evt.get_abs(i)     tuple whose first value is the reading of sensor i
+#   evt.get_time()     tuple of event time (secs, microsecs)
+# so the acquisition code runs unchanged against real or replayed boards.
+
+import os
+import errno
+import time
+import threading
+import numpy as np
+
+# backend for real balance boards using pyudev and the xwiimote bindings
+class xwiibackend:
+    'balance boards connected via bluetooth and read with xwiimote'
+
+    def __init__(self):
+        # imported here so other backends work without these installed
+        import pyudev
+        import xwiimote
+        self.pyudev = pyudev
+        self.xwiimote = xwiimote
+
+    def boards(self):
+        # returns list of pyudev devices with devtype = 'balanceboard'
+        context = self.pyudev.Context()
+        devices = self.pyudev.Enumerator(context)
+        return list(devices.match_attribute('devtype', 'balanceboard'))
+
+    def open(self, bb):
+        # returns opened xwiimote interface for board bb
+        bbdev = self.xwiimote.iface(bb.sys_path)
+        bbdev.open(self.xwiimote.IFACE_BALANCE_BOARD)
+        return bbdev
+
+    def event(self):
+        return self.xwiimote.event()
+
+    def close(self, bbdev):
+        bbdev.close(self.xwiimote.IFACE_BALANCE_BOARD)
+
+    def board_id(self, bb):
+        # returns bluetooth address of board bb, which unlike its sys_path
+        # stays the same when the board reconnects, or sys_path if not found
+        hid = bb.find_parent('hid')
+        if hid is not None and hid.properties.get('HID_UNIQ'):
+            return hid.properties['HID_UNIQ']
+        return bb.sys_path
+
+
+# class for a board recorded in a file, used in place of a pyudev device
+class replayboard:
+    'recorded balance board, sys_path is the path of the recording'
+
+    def __init__(self, sys_path, t_us, sens):
+        self.sys_path = sys_path
+        self.t_us = t_us
+        self.sens = sens
+
+
+# class to hold a replayed event
+class replayevent:
+    'event structure filled by replaydev.dispatch'
+
+    def __init__(self):
+        self.sens = (0, 0, 0, 0)
+        self.time = (0, 0)
+
+    def get_abs(self, i_s):
+        return (self.sens[i_s], 0, 0)
+
+    def get_time(self):
+        return self.time
+
+
+# class to replay recorded raw sensor data as a balance board device
+class replaydev:
+    'replayed balance board device with the xwiimote iface interface'
+
+    # bb: replayboard to replay
+    # realtime: if True events become available at their recorded times,
+    # otherwise as fast as they are dispatched
+    # loop: if True start again from the beginning at the end of the recording
+    def __init__(self, bb, realtime=True, loop=False):
+        self.t_us = np.asarray(bb.t_us, dtype=np.int64)
+        # lists are faster than numpy arrays to index one value at a time
+        self.sens = [tuple(int(v) for v in row) for row in bb.sens]
+        self.n = len(self.sens)
+        self.realtime = realtime
+        self.loop = loop
+        # times of events relative to start of recording
+        self.t_rel = (self.t_us - self.t_us[0]).tolist()
+        # recording period used to offset times when looping
+        if self.n > 1:
+            self.period = self.t_rel[-1] + (self.t_rel[-1] - self.t_rel[0])//(self.n - 1)
+        else:
+            self.period = 1
+        self.i_evt = 0
+        self.n_loop = 0
+        # replay starts now
+        self.t_start = int(time.time()*1000000)
+        # pipe used to make the device file descriptor readable
+        self.r_fd, self.w_fd = os.pipe()
+        os.set_blocking(self.r_fd, False)
+        self.runflag = True
+        if realtime:
+            # thread writes one byte to the pipe as each event is due
+            self.feeder = threading.Thread(target=self.feed, daemon=True)
+            self.feeder.start()
+        else:
+            # pipe is always readable
+            os.write(self.w_fd, b'\0')
+
+    def feed(self):
+        t0 = time.monotonic()
+        i_evt = 0
+        while self.runflag:
+            if i_evt == self.n:
+                if not self.loop:
+                    # wake the poll so dispatch can report the end of replay
+                    os.write(self.w_fd, b'\0')
+                    break
+                i_evt = 0
+                t0 += self.period/1000000
+            delay = t0 + self.t_rel[i_evt]/1000000 - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            os.write(self.w_fd, b'\0')
+            i_evt += 1
+
+    def get_fd(self):
+        return self.r_fd
+
+    def dispatch(self, evt):
+        if self.i_evt == self.n:
+            if not self.loop:
+                raise IOError(errno.ENODEV, 'end of replay')
+            self.i_evt = 0
+            self.n_loop += 1
+        if self.realtime:
+            try:
+                os.read(self.r_fd, 1)
+            except BlockingIOError:
+                raise IOError(errno.EAGAIN, 'no event available')
+        t_evt = self.t_start + self.n_loop*self.period + self.t_rel[self.i_evt]
+        evt.sens = self.sens[self.i_evt]
+        evt.time = divmod(t_evt, 1000000)
+        self.i_evt += 1
+
+    def close(self):
+        self.runflag = False
+        if self.realtime:
+            self.feeder.join()
+        os.close(self.r_fd)
+        os.close(self.w_fd)
+
+
+# backend for replaying recordings instead of using real boards
+class replaybackend:
+    'balance boards replayed from recorded raw sensor data'
+
+    # recordings: list of .wcop file paths or of (t_us, sens) tuples where
+    # t_us is an array of times in microseconds and sens an n X 4 array of
+    # raw sensor readings. One board is found for each recording
+    # realtime, loop: see replaydev
+    def __init__(self, recordings, realtime=True, loop=False):
+        self.recordings = recordings
+        self.realtime = realtime
+        self.loop = loop
+
+    def boards(self):
+        # returns a replayboard for each recording
+        from WiiCopIO import wcopfile
+        bboards = []
+        for i_r, rec in enumerate(self.recordings):
+            if isinstance(rec, str):
+                wf = wcopfile(rec)
+                bboards.append(replayboard(rec, wf.t_us, wf.sens))
+            else:
+                bboards.append(replayboard('replay{}'.format(i_r), rec[0], rec[1]))
+        return bboards
+
+    def open(self, bb):
+        return replaydev(bb, self.realtime, self.loop)
+
+    def event(self):
+        return replayevent()
+
+    def close(self, bbdev):
+        bbdev.close()
+
+    def board_id(self, bb):
+        return bb.sys_path
+
+
+# function to make n samples of synthetic raw sensor data for replaying
+def synthrecording(n, rate=65, seed=0):
+    # returns t_us, an array of times (microsecs), and sens, an n X 4 array of
+    # raw sensor readings of a subject swaying slowly on the board
+    rng = np.random.RandomState(seed)
+    t_us = np.arange(n, dtype=np.int64)*int(1000000/rate)
+    t = t_us/1000000
+    base = np.array([4000, 4200, 3900, 4100])
+    sway = np.outer(np.sin(2*np.pi*0.3*t), [150, -150, 150, -150])
+    sway += np.outer(np.cos(2*np.pi*0.2*t), [100, 100, -100, -100])
+    sens = base + sway + rng.normal(0, 20, (n, 4))
+    return t_us, sens.astype(np.int64)
+
+
+# backend used by the acquisition functions unless one is passed to them
+backend = None
+
+def get_backend():
+    # returns current backend, creating the xwiimote backend if none set
+    global backend
+    if backend is None:
+        backend = xwiibackend()
+    return backend
+
+def set_backend(new_backend):
+    # set backend used by connectBB, procBBdata and wii_thread
+    global backend
+    backend = new_backend
@@ -1,15 +1,12 @@
 # file to store functions for use by Wiicop.py
 
-import pyudev
-import xwiimote
 import errno
 import select
 import sys
 import os
 import numpy as np
-import tkinter as tk
-import tkinter.font as font
 import string
+import WiiCopDevice
 
 # function to test if string is a valid subject code
 def validcode(testnm):
@@ -53,16 +50,9 @@ def get_acq_info(s_config):
 
 # returns device object for balance board
 def connectBB():
-    # returns sys path for balance board using evdev module
-    context = pyudev.Context()
-    # get list of devices matching devtype = 'balanceboard'
-    devices = pyudev.Enumerator(context)
-    tst = devices.match_attribute('devtype', 'balanceboard')
-    # create empty list to store balance board info
-    bboards = []
-    # populate list
-    for dfg in tst:
-        bboards.append(dfg)
+    # returns device object for balance board found by the device backend
+    # (pyudev device with devtype = 'balanceboard' unless replaying)
+    bboards = WiiCopDevice.get_backend().boards()
     # test how many bboards are connected - should be only one
     if len(bboards) == 0:
         print('No Wii balance boards found')
@@ -75,19 +65,34 @@ def connectBB():
     bb = bboards[0]
     return bb
 
+# returns list of device objects for n_bb balance boards
+def connectBBs(n_bb):
+    # returns list of n_bb balance board device objects sorted by sys_path,
+    # so boards are numbered in the same order each session, or None if
+    # fewer than n_bb boards are found
+    bboards = WiiCopDevice.get_backend().boards()
+    if len(bboards) < n_bb:
+        print('{} Wii balance boards found, {} needed'.format(len(bboards), n_bb))
+        return None
+    if len(bboards) > n_bb:
+        print('{} Wii balance boards found, using first {}'.format(len(bboards), n_bb))
+    print('\nBalance boards found!\n')
+    bboards.sort(key=lambda bb: bb.sys_path)
+    return bboards[:n_bb]
+
 # function to get data from BB and process it function 'func'
 def procBBdata(bb, func, *args):
     # function to get data from BB and process it function 'func'
     # returns sens_dat that is an NX4 numpy array of raw sensor readings
     # each row a single data acquisition
     n_s = 4
-    bbdev = xwiimote.iface(bb.sys_path)
+    bknd = WiiCopDevice.get_backend()
+    # open bb device
+    bbdev = bknd.open(bb)
     p = select.poll()
     p.register(bbdev.get_fd(), select.POLLIN)
-    # open bb device
-    bbdev.open(xwiimote.IFACE_BALANCE_BOARD)
     # create xwiimote event structure
-    revt = xwiimote.event()
+    revt = bknd.event()
     # create numpy array to store data from board
     tmp_dat = np.empty((1,n_s))
     # creat another to accumulate all data
@@ -114,13 +119,15 @@ def procBBdata(bb, func, *args):
                 except IOError as e:
                     # do nothing if resource unavailable
                     if e.errno != errno.EAGAIN:
+                        # board disconnected or end of replay
                         print(e)
-                        p.unregister(bbdev.get_fd())
+                        go_flg = False
+                        break
     except KeyboardInterrupt:
         pass
     # cleaning
-    bbdev.close(xwiimote.IFACE_BALANCE_BOARD)
     p.unregister(bbdev.get_fd())
+    bknd.close(bbdev)
     return sens_dat
 
 # function to calculate COP
@@ -135,6 +142,32 @@ def calcCOP(indat,cal_mod,BB_X, BB_Y):
     cop_y = BB_Y/2*(cal_dat[0]+cal_dat[2]- (cal_dat[1]+cal_dat[3])) / (cal_dat[0]+cal_dat[1]+cal_dat[2]+cal_dat[3])
     return np.array([cop_x, cop_y])
 
+# function to calculate COP for a block of samples in one pass
+def calcCOPbatch(sens,cal_mod,BB_X,BB_Y,cop_out=None,load_out=None):
+    # inputs: 'sens' an N X N_S numpy array of raw sensor readings, one row per sample
+    # 'cal_mod': a 2 X N_S numpy array, 1st row are scale values, 2nd row are offsets
+    # BB_X, BB_Y - size of balance boad in mm
+    # 'cop_out', 'load_out': optional N X 2 and N arrays to write results into
+    # returns N X 2 array of cop x, cop y and N array of total calibrated load
+    # The calibration is folded into one matrix so that the weighted sums for
+    # cop x, cop y and the total load come from a single matrix product
+    n = sens.shape[0]
+    # sign of each sensor in numerator of cop x, cop y and in total load
+    sgn = np.array([[1,1,1],[1,-1,1],[-1,1,1],[-1,-1,1]])
+    wgt = cal_mod[0,:,np.newaxis]*sgn
+    off = np.dot(cal_mod[1,:],sgn)
+    sums = np.dot(sens,wgt)
+    sums += off
+    if cop_out is None:
+        cop_out = np.empty((n,2))
+    if load_out is None:
+        load_out = np.empty(n)
+    load_out[:] = sums[:,2]
+    np.divide(sums[:,0:2],sums[:,2:3],out=cop_out)
+    cop_out[:,0] *= BB_X/2
+    cop_out[:,1] *= BB_Y/2
+    return cop_out, load_out
+
 # function to get n_samp samples from the wii board
 def getnsamp(go_flg, tmp_dat, sens_dat, n_samp):
     # function to get n_samp samples from the wii board
@@ -149,6 +182,43 @@ def getnsamp(go_flg, tmp_dat, sens_dat, n_samp):
         go_flg = False
     return go_flg, sens_dat
 
+# class to get n_samp samples from the wii board into a preallocated array
+class fillnsamp:
+    'function for procBBdata that fills a preallocated N X N_S array in place'
+
+    def __init__(self, n_samp, n_s=4):
+        self.dat = np.empty((n_samp,n_s))
+        self.n = 0
+
+    def __call__(self, go_flg, tmp_dat, sens_dat):
+        # functions called by procBBdata must have parameters:
+        # go_flg, tmp_dat, sens_dat. sens_dat is ignored and the filled rows
+        # of the preallocated array returned instead
+        if self.n < self.dat.shape[0]:
+            self.dat[self.n] = tmp_dat[0]
+            self.n += 1
+        go_flg = self.n < self.dat.shape[0]
+        return go_flg, self.dat[:self.n]
+
+# function to get robust statistics of calibration samples of all sensors
+def robuststats(sens_dat, out_thresh):
+    # inputs: 'sens_dat' an N X N_S numpy array of raw sensor readings
+    # 'out_thresh' z-score beyond which readings are rejected as outliers
+    # returns N_S arrays of percentage of readings == 0, mean of readings
+    # excluding outliers and number of outliers, calculated for all sensors
+    # at once. z-scores use the population standard deviation, as
+    # scipy.stats.zscore. Sensors with constant readings have no outliers
+    n = sens_dat.shape[0]
+    prctzero = np.count_nonzero(sens_dat == 0, axis=0)/n*100
+    mn = sens_dat.mean(axis=0)
+    dev = sens_dat - mn
+    sd = np.sqrt(np.mean(dev*dev, axis=0))
+    np.abs(dev, out=dev)
+    keep = dev <= out_thresh*sd
+    n_keep = np.count_nonzero(keep, axis=0)
+    rob_mn = np.where(keep, sens_dat, 0).sum(axis=0)/n_keep
+    return prctzero, rob_mn, n - n_keep
+
 # funtion to get choice from a list
 def txtmenu(tit_str,opt_lst):
     # funtion to get choice from a list
@@ -188,6 +258,9 @@ def listdirs(strt_dir):
 def get_sessionname(prev_lst,def_name):
     # function to take list of previous session names and a default name for new
     # session and return users choice of new session name
+    # tkinter imported here so acquisition doesn't wait for it to load
+    import tkinter as tk
+    import tkinter.font as font
     # INITIALISE parameters
     # background colour
     bcol = 'linen'
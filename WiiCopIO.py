@@ -0,0 +1,290 @@
+# file to store functions to read and write wiicop data files
+#
+# load_cop reads the cop of a data file of any of the formats saved by
+# wiicop.py: csv files, binary wiicop files (below) and the pickled .dat files
+# of earlier versions, detected from the start of the file
+
+# Binary wiicop (.wcop) file layout:
+#   magic (4 bytes) 'WCOP'
+#   version (uint16, little endian)
+#   header length in bytes (uint32, little endian)
+#   json header (utf-8), padded with spaces so that data starts on a
+#   WCOP_ALIGN byte boundary. It holds the format version, the record fields
+#   and a 'meta' dictionary of acquisition info, including the calibration
+#   model 'cal_mod' and board size 'BB_X', 'BB_Y'
+#   data: one fixed size record per sample, see WCOP_DTYPE
+# The number of samples is not stored but given by the size of the file, so
+# records can be appended while recording.
+# Version 1 files also stored the cop of each sample. From version 2 only the
+# raw sensor readings are stored and the cop is calculated when read. Version
+# 3 adds the time on the monotonic time base shared by all boards
+
+import os
+import json
+import time
+import pickle
+import struct
+import numpy as np
+from WiiCopFunctions import calcCOPbatch
+
+# ending added to the path of a data file (without extension) for its
+# timing quality sidecar file
+TIMING_EXT = '.timing.json'
+
+# columns of csv files written by wiicop.py. Older files and those saved by
+# read_datfile.py have some of these columns. Names are matched ignoring case
+CSV_COLS = ('copx','copy','time','mtime','topr','botr','topl','botl')
+# columns of raw sensor readings, in the order of the calibration model
+CSV_SENS = ('topr','botr','topl','botl')
+# Balance board width and length in mm, used to recalculate the cop of csv
+# and pickled files (see BB_X, BB_Y in wiicop.py)
+BB_DIMS = (433, 238)
+
+# magic bytes at start of binary wiicop files
+WCOP_MAGIC = b'WCOP'
+# current version of binary format
+WCOP_VERSION = 3
+# struct format of magic, version and header length
+WCOP_PRE = '<4sHI'
+WCOP_PRE_SIZE = struct.calcsize(WCOP_PRE)
+# alignment of start of data in bytes
+WCOP_ALIGN = 64
+# fields of each sample record: event time in microseconds, time on the
+# shared monotonic time base in microseconds and raw readings of the 4
+# sensors (see SENS_DCT in wiicop.py for order)
+WCOP_DTYPE = np.dtype([('t_us','<i8'),('mono_us','<i8'),('sens','<i4',(4,))])
+
+# function to make the header of a binary wiicop file
+def wcop_header(meta, dtype=WCOP_DTYPE):
+    # returns the header as bytes
+    # meta: dictionary of acquisition info, must be json serialisable
+    hdr = {'version':WCOP_VERSION, 'fields':dtype.descr, 'meta':meta}
+    js = json.dumps(hdr).encode('utf-8')
+    # pad so data is aligned
+    n_pad = -(WCOP_PRE_SIZE + len(js)) % WCOP_ALIGN
+    js += b' '*n_pad
+    return struct.pack(WCOP_PRE, WCOP_MAGIC, WCOP_VERSION, len(js)) + js
+
+# function to get the path of the timing quality sidecar of a data file
+def timing_path(fpath):
+    return os.path.splitext(fpath)[0] + TIMING_EXT
+
+# function to save timing quality statistics next to a data file
+def write_timing(fpath, stats):
+    # stats: dictionary of statistics, see timingstats in WiiCopAcq.py
+    tpath = timing_path(fpath)
+    with open(tpath + '.part', 'w') as fptr:
+        json.dump(stats, fptr, indent=1)
+    os.replace(tpath + '.part', tpath)
+
+# function to read the timing quality statistics of a data file
+def read_timing(fpath):
+    # returns dictionary of statistics or None if the file has no sidecar
+    tpath = timing_path(fpath)
+    if not os.path.isfile(tpath):
+        return None
+    with open(tpath) as fptr:
+        return json.load(fptr)
+
+# function to read the calibration cache
+def read_calcache(fpath):
+    # returns dictionary of calibrations keyed by board id, empty if no cache.
+    # Each calibration is a dictionary with 'model' (cal_mod), 'details'
+    # (fit of each sensor), 'units' (of calibration weights) and 'time'
+    # (time.time() when calibrated)
+    if not os.path.isfile(fpath):
+        return {}
+    with open(fpath, 'rb') as fptr:
+        return pickle.load(fptr)
+
+# function to store a calibration in the calibration cache
+def write_calcache(fpath, bb_id, cal_mod, cal_dat, units):
+    cache = read_calcache(fpath)
+    cache[bb_id] = {'model':cal_mod, 'details':cal_dat, 'units':units, 'time':time.time()}
+    with open(fpath + '.part', 'wb') as fptr:
+        pickle.dump(cache, fptr)
+    os.replace(fpath + '.part', fpath)
+
+# function to detect the format of a data file
+def data_format(fpath):
+    # returns 'wcop', 'pickle' or 'csv' from the first bytes of the file
+    with open(fpath, 'rb') as fptr:
+        head = fptr.read(8)
+    if head.startswith(WCOP_MAGIC):
+        return 'wcop'
+    # pickle protocol 2 and above
+    if head[:1] == b'\x80':
+        return 'pickle'
+    if head.lower().startswith(b'copx,'):
+        return 'csv'
+    raise ValueError('{} is not a wiicop data file'.format(fpath))
+
+# function to read columns of a wiicop csv file
+def read_csv(fpath, cols=('copx','copy','time')):
+    # returns n X len(cols) array of the columns cols (see CSV_COLS). The
+    # header is checked and then only the numbers of the columns asked for
+    # are parsed, with no type inference or quoting
+    with open(fpath) as fptr:
+        names = fptr.readline().strip().lower().split(',')
+        for col in cols:
+            if col not in names:
+                raise ValueError('{} has no {} column'.format(fpath, col))
+        usecols = [names.index(col) for col in cols]
+        # header only, e.g. an aborted acquisition
+        pos = fptr.tell()
+        if not fptr.readline().strip():
+            return np.empty((0, len(cols)))
+        fptr.seek(pos)
+        dat = np.loadtxt(fptr, delimiter=',', usecols=usecols, comments=None, ndmin=2)
+    return dat
+
+# function to read the cop of a data file of any format
+def load_cop(fpath, cal_mod=None, bb_dims=BB_DIMS):
+    # returns n X 3 array of cop x, cop y and time in seconds since the
+    # first sample, as used by the functions in COPparamsFs
+    # cal_mod: calibration model to recalculate the cop with from the raw
+    # sensor readings, None to use the cop stored in the file
+    # bb_dims: width and length of board (mm) for recalculating the cop of
+    # csv and pickled files. Binary files store their own
+    fmt = data_format(fpath)
+    if fmt == 'wcop':
+        return wcopfile(fpath, cal_mod=cal_mod).cop_dat()
+    if fmt == 'csv':
+        if cal_mod is None:
+            out = read_csv(fpath)
+            if out.shape[0] > 0:
+                out[:,2] -= out[0,2]
+            return out
+        dat = read_csv(fpath, ('time',) + CSV_SENS)
+        t, sens = dat[:,0], dat[:,1:]
+        if t.size > 0:
+            t = t - t[0]
+    else:
+        # pickled file of earlier versions
+        with open(fpath, 'rb') as fptr:
+            pkl = pickle.load(fptr)
+        t = pkl['timedat'][:,0] + pkl['timedat'][:,1]/1000000
+        if t.size > 0:
+            t = t - t[0]
+        if cal_mod is None:
+            out = np.empty((t.size, 3))
+            out[:,(0,1)] = pkl['cop']
+            out[:,2] = t
+            return out
+        sens = pkl['rawsens']
+    out = np.empty((t.size, 3))
+    calcCOPbatch(sens, np.asarray(cal_mod), bb_dims[0], bb_dims[1], cop_out=out[:,0:2])
+    out[:,2] = t
+    return out
+
+# function to convert the field list in a json header back to a numpy dtype
+def descr2dtype(fields):
+    descr = []
+    for fld in fields:
+        if len(fld) == 3:
+            descr.append((fld[0], fld[1], tuple(fld[2])))
+        else:
+            descr.append((fld[0], fld[1]))
+    return np.dtype(descr)
+
+# class to read binary wiicop files
+class wcopfile:
+    'memory-mapped reader for binary wiicop (.wcop) files'
+
+    # fpath: path of file
+    # cal_mod: optional calibration model to calculate the cop with instead
+    # of the one stored in the file, e.g. to recalibrate a study
+    def __init__(self, fpath, cal_mod=None):
+        self.fpath = fpath
+        with open(fpath, 'rb') as fptr:
+            magic, vers, hlen = struct.unpack(WCOP_PRE, fptr.read(WCOP_PRE_SIZE))
+            if magic != WCOP_MAGIC:
+                raise ValueError('{} is not a binary wiicop file'.format(fpath))
+            if vers > WCOP_VERSION:
+                raise ValueError('{} has unsupported version {}'.format(fpath, vers))
+            hdr = json.loads(fptr.read(hlen).decode('utf-8'))
+        self.version = vers
+        self.meta = hdr['meta']
+        self.dtype = descr2dtype(hdr['fields'])
+        offset = WCOP_PRE_SIZE + hlen
+        # ignore any incomplete record at the end of the file
+        n = (os.path.getsize(fpath) - offset) // self.dtype.itemsize
+        if n > 0:
+            self.data = np.memmap(fpath, dtype=self.dtype, mode='r', offset=offset, shape=(n,))
+        else:
+            self.data = np.empty(0, dtype=self.dtype)
+        # cop of all samples, calculated when first used
+        self.cop_cache = None
+        if cal_mod is not None:
+            self.cal_mod = np.asarray(cal_mod)
+        elif 'cal_mod' in self.meta:
+            self.cal_mod = np.array(self.meta['cal_mod'])
+        else:
+            self.cal_mod = None
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, key):
+        # slices of the records, e.g. f[100:200]['sens']. No data is read
+        # from disk until it is used
+        return self.data[key]
+
+    @property
+    def t_us(self):
+        return self.data['t_us']
+
+    @property
+    def mono(self):
+        # time in seconds on the time base shared by all boards of the
+        # session, or None for files from before version 3
+        if 'mono_us' not in self.dtype.names:
+            return None
+        return self.data['mono_us']/1000000
+
+    @property
+    def sens(self):
+        return self.data['sens']
+
+    @property
+    def cop(self):
+        # n X 2 array of cop x, cop y calculated from the raw sensor readings
+        # and calibration model on first use and cached
+        if self.cop_cache is None:
+            self.cop_cache = self.calc_cop(slice(None))
+        return self.cop_cache
+
+    def calc_cop(self, key):
+        # returns cop of samples key
+        if self.cal_mod is None:
+            if 'cop' in self.dtype.names:
+                # version 1 file without calibration model
+                return self.data['cop'][key]
+            raise ValueError('{} has no calibration model'.format(self.fpath))
+        sens = self.data['sens'][key]
+        cop, load = calcCOPbatch(sens, self.cal_mod, self.meta['BB_X'], self.meta['BB_Y'])
+        return cop
+
+    def recalibrate(self, cal_mod):
+        # use a new calibration model for the cop
+        self.cal_mod = np.asarray(cal_mod)
+        self.cop_cache = None
+
+    def time(self, key=slice(None)):
+        # returns time in seconds since the first sample
+        if len(self) == 0:
+            return np.empty(0)
+        return (self.data['t_us'][key] - self.data['t_us'][0])/1000000
+
+    def cop_dat(self, key=slice(None)):
+        # returns n X 3 array of cop x, cop y and time (seconds) as used by
+        # the functions in COPparamsFs
+        if self.cop_cache is not None:
+            cop = self.cop_cache[key]
+        else:
+            # only calculate the cop for the samples asked for
+            cop = self.calc_cop(key)
+        out = np.empty((cop.shape[0], 3))
+        out[:,(0,1)] = cop
+        out[:,2] = self.time(key)
+        return out
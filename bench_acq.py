@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# benchmark of the wiicop.py acquisition path using replayed synthetic data,
+# so no balance board is needed. Results are printed and saved as json so
+# they can be compared between commits, e.g.
+#   ./bench_acq.py --out before.json
+#   ./bench_acq.py --out after.json --compare before.json
+
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from queue import Queue
+import numpy as np
+import WiiCopDevice
+from WiiCopAcq import wii_thread, wii_async, wii_process, asyncloop, sampbuffer, chunkwriter, wcopwriter, ROW_SENS
+from WiiCopFunctions import calcCOP, calcCOPbatch
+
+# Balance board dimensions width and length in mm
+BB_Y = 238
+BB_X = 433
+# calibration model used for all benchmarks
+CAL_MOD = np.array([[0.0178,0.0165,0.0237,0.0225],[0.39,-0.73,-0.05,-3.55]])
+# sample rate of synthetic recording
+SYNTH_RATE = 65
+
+
+# class to record when each sample is stored by wii_thread
+class timedbuffer(sampbuffer):
+    'sampbuffer that records the time each sample is put'
+
+    def __init__(self, n_max, *args, **kwargs):
+        sampbuffer.__init__(self, *args, **kwargs)
+        self.t_put = np.empty(n_max)
+
+    def put(self, row):
+        if self.n < self.t_put.size:
+            self.t_put[self.n] = time.time()
+        sampbuffer.put(self, row)
+
+
+# class to record when each chunk reaches the file
+class timedwriter(chunkwriter):
+    'chunkwriter that records the time each sample is written'
+
+    def __init__(self, fpath, n_max, **kwargs):
+        chunkwriter.__init__(self, fpath, CAL_MOD, BB_X, BB_Y, **kwargs)
+        self.t_wrt = np.empty(n_max)
+
+    def write_rows(self, fptr, rows):
+        chunkwriter.write_rows(self, fptr, rows)
+        fptr.flush()
+        i_end = min(self.n + rows.shape[0], self.t_wrt.size)
+        self.t_wrt[self.n:i_end] = time.time()
+
+
+# function to percentiles of an array as a dictionary
+def pcntls(arr, pcs=(50, 90, 95, 99, 100)):
+    if arr.size == 0:
+        return {}
+    vals = np.percentile(arr, pcs)
+    return {'p{}'.format(pc):float(v) for pc, v in zip(pcs, vals)}
+
+
+# function to run wii_thread (or wii_async if engine is 'asyncio' or
+# wii_process if 'process') on a replayed recording of n samples
+def run_thread(n, realtime, chunk_len, tmp_dir, fmt='csv', timed=False, trace_mem=False,
+    engine='thread'):
+    # returns engine, writer, wall time taken and peak memory allocated
+    # during acquisition if trace_mem, otherwise None. If timed the time
+    # each sample is stored and written is recorded
+    rec = WiiCopDevice.synthrecording(n, rate=SYNTH_RATE)
+    bknd = WiiCopDevice.replaybackend([rec], realtime=realtime)
+    bb = bknd.boards()[0]
+    sfn = os.path.join(tmp_dir, 'bench.'+fmt)
+    if fmt == 'wcop':
+        wrt = wcopwriter(sfn, {'bench':True}, CAL_MOD, BB_X, BB_Y, chunk_len=chunk_len)
+    elif timed:
+        wrt = timedwriter(sfn, n)
+    else:
+        wrt = chunkwriter(sfn, CAL_MOD, BB_X, BB_Y)
+    if engine != 'process':
+        wrt.start()
+    if engine == 'process':
+        thd = wii_process(bb, CAL_MOD, BB_X, BB_Y, wrt, chunk_len=chunk_len, bknd=bknd)
+    elif engine == 'asyncio':
+        acq_loop = asyncloop()
+        acq_loop.start()
+        thd = wii_async(bb, CAL_MOD, BB_X, BB_Y, wrt, acq_loop.loop, chunk_len=chunk_len, bknd=bknd)
+    else:
+        thd = wii_thread(bb, CAL_MOD, BB_X, BB_Y, wrt, chunk_len=chunk_len, bknd=bknd)
+    if timed:
+        thd.acq_buf = timedbuffer(n, ROW_SENS+thd.n_s, chunk_len=chunk_len, sink=wrt)
+    thd.storeflag = True
+    if engine == 'process':
+        thd.set_flags(True, True)
+    # trace memory once the replayed recording has been loaded
+    if trace_mem:
+        tracemalloc.start()
+    t_start = time.perf_counter()
+    thd.start()
+    # thread stops at end of replay
+    thd.join()
+    if engine != 'process':
+        wrt.close()
+    t_total = time.perf_counter() - t_start
+    if engine == 'asyncio':
+        acq_loop.stop()
+    peak = None
+    if trace_mem:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return thd, wrt, t_total, peak
+
+
+# benchmark of maximum throughput of the acquisition thread
+def bench_throughput(n, chunk_len, tmp_dir):
+    res = {}
+    for fmt in ('csv', 'wcop'):
+        thd, wrt, t_total, peak = run_thread(n, False, chunk_len, tmp_dir, fmt)
+        res[fmt] = {'samples':int(wrt.n), 'secs':t_total, 'samples_per_sec':wrt.n/t_total}
+    # asyncio engine reading the same recording
+    thd, wrt, t_total, peak = run_thread(n, False, chunk_len, tmp_dir, 'wcop', engine='asyncio')
+    res['wcop_asyncio'] = {'samples':int(wrt.n), 'secs':t_total, 'samples_per_sec':wrt.n/t_total}
+    # worker process, counted in the parent from the shared memory
+    thd, wrt, t_total, peak = run_thread(n, False, chunk_len, tmp_dir, 'wcop', engine='process')
+    res['wcop_process'] = {'samples':thd.n_stored, 'secs':t_total,
+        'samples_per_sec':thd.n_stored/t_total}
+    return res
+
+
+# benchmark of timing of acquisition thread replaying at the recorded rate
+def bench_realtime(secs, chunk_len, tmp_dir):
+    n = int(secs*SYNTH_RATE)
+    thd, wrt, t_total, peak = run_thread(n, True, chunk_len, tmp_dir, timed=True)
+    n_st = min(thd.acq_buf.n, n)
+    t_put = thd.acq_buf.t_put[:n_st]
+    # recorded event times of stored samples
+    rec_t = WiiCopDevice.synthrecording(n, rate=SYNTH_RATE)[0][:n_st]
+    # inter-sample intervals and jitter relative to nominal interval (ms)
+    dt = np.diff(t_put)*1000
+    nom = 1000/SYNTH_RATE
+    # latency from event becoming available to storage in buffer and file.
+    # Events are replayed from the time the device was opened
+    t_evt = thd.bbdev.t_start/1000000 + (rec_t - rec_t[0])/1000000
+    lat_buf = (t_put - t_evt)*1000
+    lat_file = (wrt.t_wrt[:n_st] - t_evt)*1000
+    return {'samples':int(n_st), 'secs':t_total, 'samples_per_sec':n_st/t_total,
+        'interval_ms':pcntls(dt), 'jitter_ms':pcntls(np.abs(dt - nom)),
+        'latency_buffer_ms':pcntls(lat_buf), 'latency_file_ms':pcntls(lat_file)}
+
+
+# benchmark of memory used per minute of recording: the growth of the peak
+# between recordings of n/2 and n samples, so fixed costs don't count
+def bench_memory(n, chunk_len, tmp_dir):
+    peaks = []
+    mins = []
+    for n_rec in (n//2, n):
+        thd, wrt, t_total, peak = run_thread(n_rec, False, chunk_len, tmp_dir, trace_mem=True)
+        peaks.append(peak)
+        mins.append(n_rec/SYNTH_RATE/60)
+    return {'samples':n, 'recording_mins':mins[1], 'peak_bytes':peaks[1],
+        'bytes_per_min':(peaks[1] - peaks[0])/(mins[1] - mins[0])}
+
+
+# benchmark of calcCOP per sample and calcCOPbatch per chunk
+def bench_calccop(n, chunk_len):
+    sens = WiiCopDevice.synthrecording(n, rate=SYNTH_RATE)[1].astype(float)
+    tmp_dat = np.empty((1,4))
+    t_start = time.perf_counter()
+    for i_r in range(n):
+        tmp_dat[0,:] = sens[i_r]
+        calcCOP(tmp_dat, CAL_MOD, BB_X, BB_Y)
+    t_single = time.perf_counter() - t_start
+    cop_out = np.empty((chunk_len,2))
+    load_out = np.empty(chunk_len)
+    t_start = time.perf_counter()
+    for i_r in range(0, n - chunk_len + 1, chunk_len):
+        calcCOPbatch(sens[i_r:i_r+chunk_len], CAL_MOD, BB_X, BB_Y, cop_out, load_out)
+    t_batch = time.perf_counter() - t_start
+    return {'calls':n, 'us_per_call':t_single/n*1000000,
+        'batch_us_per_sample':t_batch/(n//chunk_len*chunk_len)*1000000}
+
+
+# benchmark of storing and saving samples: the old queue, vstack drain and
+# dataframe path against the chunk buffer
+def bench_storage(n, chunk_len, tmp_dir):
+    rows = np.random.RandomState(0).normal(size=(n, ROW_SENS+4))
+    res = {}
+    # queue of per-sample arrays drained with np.vstack
+    t_start = time.perf_counter()
+    wii_q = Queue(maxsize=0)
+    for i_r in range(n):
+        wii_q.put(np.concatenate((rows[i_r,0:2], rows[i_r,2:4])))
+    acq_data = np.empty((0,4))
+    while not(wii_q.empty()):
+        acq_data = np.vstack((acq_data,wii_q.get()))
+    t_drain = time.perf_counter() - t_start
+    try:
+        import pandas as pd
+        pd.DataFrame(data=acq_data[:,(0,1,2)],columns=('copx','copy','time')).to_csv(
+            os.path.join(tmp_dir, 'queue.csv'), index=False)
+    except ImportError:
+        pass
+    res['queue_vstack'] = {'drain_secs':t_drain, 'total_secs':time.perf_counter() - t_start}
+    # chunk buffer streamed to csv
+    t_start = time.perf_counter()
+    wrt = chunkwriter(os.path.join(tmp_dir, 'buffer.csv'), CAL_MOD, BB_X, BB_Y)
+    wrt.start()
+    buf = sampbuffer(ROW_SENS+4, chunk_len=chunk_len, sink=wrt)
+    for i_r in range(n):
+        buf.put(rows[i_r])
+    buf.flush()
+    t_put = time.perf_counter() - t_start
+    wrt.close()
+    res['chunk_buffer'] = {'put_secs':t_put, 'total_secs':time.perf_counter() - t_start}
+    res['samples'] = n
+    return res
+
+
+# function to get the current git commit of the repository
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.realpath(__file__)))
+        return out.stdout.decode().strip() or None
+    except OSError:
+        return None
+
+
+# function to print ratio of new to old results for each numeric value
+def compare(new, old, pre=''):
+    for key, val in new.items():
+        if key not in old:
+            continue
+        if isinstance(val, dict):
+            compare(val, old[key], pre+key+'.')
+        elif isinstance(val, (int, float)) and old[key]:
+            print('{:<50} {:>14.4g} {:>14.4g} {:>8.2f}x'.format(pre+key, old[key], val, val/old[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the wiicop acquisition path')
+    parser.add_argument('--samples', type=int, default=100000,
+        help='number of samples for throughput and memory benchmarks')
+    parser.add_argument('--realtime-secs', type=float, default=10,
+        help='length of real time replay for jitter and latency (0 to skip)')
+    parser.add_argument('--storage-samples', type=int, default=20000,
+        help='number of samples for queue/buffer comparison')
+    parser.add_argument('--chunk', type=int, default=256, help='samples per buffer chunk')
+    parser.add_argument('--out', help='json file to save results in')
+    parser.add_argument('--compare', help='json file of earlier results to compare with')
+    args = parser.parse_args()
+
+    res = {'commit':git_commit(), 'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python':platform.python_version(), 'numpy':np.__version__,
+        'machine':platform.machine(), 'processor':platform.processor(),
+        'chunk':args.chunk}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print('calcCOP...')
+        res['calccop'] = bench_calccop(min(args.samples, 20000), args.chunk)
+        print('throughput...')
+        res['throughput'] = bench_throughput(args.samples, args.chunk, tmp_dir)
+        print('memory...')
+        res['memory'] = bench_memory(args.samples, args.chunk, tmp_dir)
+        print('storage...')
+        res['storage'] = bench_storage(args.storage_samples, args.chunk, tmp_dir)
+        if args.realtime_secs > 0:
+            print('real time replay...')
+            res['realtime'] = bench_realtime(args.realtime_secs, args.chunk, tmp_dir)
+    print(json.dumps(res, indent=2))
+    if args.out:
+        with open(args.out, 'w') as fptr:
+            json.dump(res, fptr, indent=2)
+    if args.compare:
+        with open(args.compare) as fptr:
+            old = json.load(fptr)
+        print('\n{:<50} {:>14} {:>14} {:>9}'.format('', 'old', 'new', 'new/old'))
+        compare(res, old)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# benchmark of the start up time of wiicop.py and GetCOPparams.py, measured
+# with python -X importtime. The import statements at the top of each script
+# (before its first other statement) are run in a fresh interpreter and the
+# time taken to import them, excluding modules the interpreter imports
+# anyway, is compared with a budget. Modules that should only be imported
+# later (e.g. pandas during acquisition) are reported if imported at start up.
+# Exits with status 1 if a budget is exceeded or a deferred module imported:
+#   ./bench_startup.py --out startup.json
+
+import os
+import ast
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+# directory of scripts
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+# scripts to benchmark: budget for start up imports (milliseconds) and
+# modules that must not be imported at start up
+STARTUP = {
+    'wiicop.py':{'budget_ms':100, 'deferred':['pandas','scipy','matplotlib','tkinter']},
+    'GetCOPparams.py':{'budget_ms':100, 'deferred':['pandas','scipy','matplotlib']},
+}
+
+
+# function to get the import statements at the top of a script
+def startup_imports(fpath):
+    # returns source of the import statements before the first statement of
+    # the script that isn't an import (a leading docstring is skipped)
+    with open(fpath) as fptr:
+        src = fptr.read()
+    tree = ast.parse(src)
+    lines = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(ast.get_source_segment(src, node))
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and not lines:
+            continue
+        else:
+            break
+    return '\n'.join(lines)
+
+
+# function to run code with -X importtime
+def importtime(code):
+    # returns list of (cumulative microsecs, module name, nesting level) for
+    # each module imported
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SCRIPT_DIR,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    mods = []
+    for line in out.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1)//2
+        mods.append((int(cum_us), name.strip(), level))
+    return mods
+
+
+# function to benchmark start up imports of a script
+def bench_script(fname, budget_ms, deferred, repeat):
+    code = startup_imports(os.path.join(SCRIPT_DIR, fname))
+    # modules imported by the interpreter itself
+    base = {name for cum, name, level in importtime('pass')}
+    totals = []
+    slowest = {}
+    for i_r in range(repeat):
+        mods = importtime(code)
+        # top level imports not done by the interpreter anyway
+        top = [(cum, name) for cum, name, level in mods if level == 0 and name not in base]
+        totals.append(sum(cum for cum, name in top)/1000)
+        for cum, name in top:
+            slowest.setdefault(name, []).append(cum/1000)
+    names = {name for cum, name, level in mods}
+    found = sorted(mod for mod in deferred if mod in names)
+    slowest = sorted(((float(np.median(v)), k) for k, v in slowest.items()), reverse=True)[:10]
+    total = float(np.median(totals))
+    return {'import_ms':total, 'import_ms_min':float(min(totals)), 'budget_ms':budget_ms,
+        'over_budget':total > budget_ms, 'deferred_imported':found,
+        'slowest_ms':{k:v for v, k in slowest}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark start up imports of the wiicop scripts')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs per script')
+    parser.add_argument('--scale', type=float, default=1,
+        help='multiply budgets by this, e.g. for slower machines')
+    parser.add_argument('--out', help='json file to save results in')
+    args = parser.parse_args()
+
+    res = {'date':time.strftime('%Y-%m-%dT%H:%M:%S'), 'python':sys.version.split()[0]}
+    fail = False
+    for fname, opts in STARTUP.items():
+        r = bench_script(fname, opts['budget_ms']*args.scale, opts['deferred'], args.repeat)
+        res[fname] = r
+        print('{:<18} {:>8.1f}ms (budget {:.0f}ms)'.format(fname, r['import_ms'], r['budget_ms']))
+        if r['over_budget']:
+            print('  over budget')
+            fail = True
+        if r['deferred_imported']:
+            print('  imports at start up: {}'.format(', '.join(r['deferred_imported'])))
+            fail = True
+    print(json.dumps(res, indent=2))
+    if args.out:
+        with open(args.out, 'w') as fptr:
+            json.dump(res, fptr, indent=2)
+    sys.exit(1 if fail else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# check that the batch functions of COPparamsFs give the same results as the
+# per trial functions (resamp, bfilt, pathl, PI95) for packed trials of
+# different lengths, packed trials of the same length and a 3-D stack of
+# trials. Trials are synthetic cop paths with irregular sample times.
+# Exits with status 1 if any difference is larger than the tolerance:
+#   ./check_batch.py
+
+import sys
+import argparse
+import numpy as np
+import COPparamsFs as cp
+
+# relative tolerance of differences
+RTOL = 1e-9
+# Butterworth cutoff (fraction of Nyquist frequency) and order, as
+# GetCOPparams.py
+CUTOFF = 2/3
+ORDER = 4
+
+
+# function to make a synthetic trial
+def synthtrial(n, rng):
+    # returns n X 3 array of cop x, cop y and time of a subject swaying
+    # slowly, sampled at about 65Hz with jitter
+    t = np.cumsum(rng.uniform(0.010, 0.020, n))
+    t -= t[0]
+    x = 20*np.sin(2*np.pi*0.3*t + rng.uniform(0, np.pi)) + rng.normal(0, 1, n)
+    y = 15*np.cos(2*np.pi*0.2*t + rng.uniform(0, np.pi)) + rng.normal(0, 1, n)
+    return np.column_stack((x, y, t))
+
+
+# function to get the largest relative difference
+def reldiff(batch, single):
+    # returns largest difference between arrays relative to largest magnitude
+    # of single
+    batch = np.asarray(batch)
+    single = np.asarray(single)
+    return float(np.max(np.abs(batch - single))/max(np.max(np.abs(single)), 1e-300))
+
+
+# function to check the batch functions on a list of trials
+def check_trials(trials, stack):
+    # stack: if True pass trials as a 3-D stack, else packed
+    # returns dictionary of function name to largest relative difference
+    if stack:
+        cop_dat, offs = np.stack(trials), None
+    else:
+        cop_dat, offs = cp.pack(trials)
+    # per trial
+    rs = [cp.resamp(trial) for trial in trials]
+    fs = [cp.bfilt(trial, CUTOFF, ORDER) for trial in rs]
+    # batch
+    r_b = cp.resamp_batch(cop_dat, offs)
+    f_b = cp.bfilt_batch(r_b, CUTOFF, ORDER, offs)
+    if stack:
+        r_b = list(r_b)
+        f_b = list(f_b)
+    else:
+        r_b = cp.unpack(r_b, offs)
+        f_b = cp.unpack(f_b, offs)
+    return {'resamp':max(reldiff(b, s) for b, s in zip(r_b, rs)),
+        'bfilt':max(reldiff(b, s) for b, s in zip(f_b, fs)),
+        'pathl':reldiff(cp.pathl_batch(cop_dat, offs), [cp.pathl(trial) for trial in trials]),
+        'PI95':reldiff(cp.PI95_batch(np.stack(fs) if stack else cp.pack(fs)[0], offs),
+            [cp.PI95(trial) for trial in fs])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the COPparamsFs batch functions against the per trial functions')
+    parser.add_argument('--trials', type=int, default=12, help='number of trials per check')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic trials')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    ragged = [synthtrial(rng.randint(500, 3000), rng) for i_t in range(args.trials)]
+    same = [synthtrial(1500, rng) for i_t in range(args.trials)]
+    checks = {'packed, different lengths':check_trials(ragged, False),
+        'packed, same length':check_trials(same, False),
+        '3-D stack':check_trials(same, True)}
+    fail = False
+    for name, res in checks.items():
+        print(name)
+        for fname, diff in res.items():
+            ok = diff <= RTOL
+            fail = fail or not ok
+            print('  {:<8} {:.2e} {}'.format(fname, diff, 'ok' if ok else 'FAIL'))
+    sys.exit(1 if fail else 0)
+
+
+if __name__ == '__main__':
+    main()
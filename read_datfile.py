@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-# to read a pickled file into memory
+# to read a data file (csv, binary or pickled) into memory
 import tkinter.filedialog as tk_fd
 import pickle
 import numpy as np
@@ -8,36 +8,31 @@ import matplotlib.pyplot as plt
 from scipy import signal
 from scipy.interpolate import interp1d
 import math
+from WiiCopIO import data_format, load_cop
 
 doplots = True
+# save pickled files as CSV files
 savecsv = False
 
-dfile = tk_fd.askopenfilename(title = 'Get pickled data file',filetypes=[('Data files', '*.dat'), ('All files','*')])
+dfile = tk_fd.askopenfilename(title = 'Get data file',filetypes=[('Data files', '*.dat *.wcop *.csv'), ('All files','*')])
 if not dfile:
     print('No file chosen')
     sys.exit(0)
-with open(dfile,'rb') as fptr:
-    dc = pickle.load(fptr, fix_imports=False)
-# convert time data into seconds
-#t_dat = dc['timedat'].astype(int)
-t_dat = dc['timedat']
-# print(t_dat)
-# print(t_dat[:,1]/1000000)
-t_dat = t_dat[:,0] + t_dat[:,1]/1000000
-# reshape t_dat so that it is an nd array with one singleton dimension
-t_dat = np.reshape(t_dat,(t_dat.size,-1))
-# subtract the first time value from all
-t_dat = np.subtract(t_dat,t_dat[0])
-# add time data to cop data
-bb_dat = np.concatenate((dc['cop'],t_dat), axis=1)
+# cop x, cop y and time in seconds since first sample
+bb_dat = load_cop(dfile)
 n_samp = bb_dat.shape[0]
-# add raw sensor data
-bb_dat = np.concatenate((bb_dat,dc['rawsens']), axis=1)
 # save each numpy array as a CSV file...
 if savecsv:
-    fname = tk_fd.asksaveasfilename(title='Choose file name to save BB data', filetypes=[('CSV files', '.csv'), ('all files', '.*')])
-    if fname:
-        np.savetxt(fname,bb_dat, delimiter=',', header='copX,copY,time,TopR,BotR,TopL,BotL', comments='')
+    if data_format(dfile) != 'pickle':
+        print('{} is not a pickled file'.format(dfile))
+    else:
+        with open(dfile,'rb') as fptr:
+            dc = pickle.load(fptr, fix_imports=False)
+        # add raw sensor data
+        bb_dat = np.concatenate((bb_dat,dc['rawsens']), axis=1)
+        fname = tk_fd.asksaveasfilename(title='Choose file name to save BB data', filetypes=[('CSV files', '.csv'), ('all files', '.*')])
+        if fname:
+            np.savetxt(fname,bb_dat, delimiter=',', header='copX,copY,time,TopR,BotR,TopL,BotL', comments='')
 # plot statokinesiogram - coronal plane using time as x-axis
 if doplots:
 
@@ -5,23 +5,19 @@ import os
 import sys
 from subprocess import run
 import time
-import threading
-from queue import Queue
-import errno
 import numpy as np
-import pandas as pd
 import pickle
-from scipy import stats
-import pyudev
-import xwiimote
-import select
 import configparser
-from WiiCopFunctions import connectBB, calcCOP, procBBdata, txtmenu,\
-get_sessionname, listdirs, get_acq_info, getnsamp, validcode
+from WiiCopFunctions import connectBB, connectBBs, procBBdata, txtmenu,\
+get_sessionname, listdirs, get_acq_info, fillnsamp, robuststats, validcode
+from WiiCopIO import read_calcache, write_calcache
+from WiiCopAcq import wii_thread, wii_async, wii_process, wii_board, acquire_for, asyncloop,\
+chunkwriter, wcopwriter
+import WiiCopDevice
 from datetime import datetime
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
+# matplotlib is imported by import_mpl when the cop display is first needed and
+# scipy by calibrate, so that the first prompt appears quickly and pandas and
+# scipy are never imported if a stored calibration is reused
 
 # user defined options
 # ~~~~~~~~~~~~~~~~~~~~
@@ -31,14 +27,55 @@ smp_size = 50
 out_thresh = 3
 # percentage zeros %age max limit defined here
 maxpcnt = 5
-# Pandas series to define calibration weights
-# calib_wgts = pd.Series({0:5,1:10,2:18})
-calib_wgts = pd.Series({0:8,1:12,2:16})
+# list of calibration weights
+# calib_wgts = [5,10,18]
+calib_wgts = [8,12,16]
 # calibration units ('Kgs' or 'lbs')
 # calib_units = 'lbs'
 calib_units = 'Kgs'
+# reuse of a board's last calibration, stored in calib_cache in the script
+# directory: 'never' (always do the full calibration), 'drift' (check the
+# last calibration with one weight first) or 'always' (no check)
+cal_reuse = 'drift'
+# hours a stored calibration can be reused for
+cal_valid_hrs = 12
+# index in calib_wgts of the weight used for the drift check
+drift_wgt = 1
+# largest error (% of drift check weight) for the last calibration to be reused
+drift_tol = 3
 # set the time interval for FuncAnimation (milliseconds)
 anim_interval = 50
+# redraw only the cop dot, trail and text each frame (blitting) rather than
+# the whole figure
+blit_f = True
+# longest time interval for FuncAnimation (milliseconds). The interval is
+# increased up to this if acquisition falls behind the board
+max_interval = 400
+# acquisition is behind if the latest event is older than this (milliseconds)
+max_lag = 100
+# number of displayed cops to draw as a trailing path (0 for no trail)
+trail_len = 0
+# number of samples per preallocated chunk of the acquisition buffer. Each
+# chunk is written to the session file as soon as it is full
+buf_chunk = 256
+# format to save acquisitions in: 'csv' (cop x, cop y, time and raw sensor
+# readings) or 'wcop' (binary file with times, raw sensor readings and
+# acquisition info including the calibration)
+save_fmt = 'csv'
+# number of balance boards to acquire from at the same time. Each board is
+# calibrated and saved separately, with '_bb1', '_bb2' etc. added to the
+# file names if more than one
+n_boards = 1
+# to run without a balance board list .wcop recordings to replay here (one
+# board is replayed per recording)
+replay_files = []
+# replay at the recorded timing (True) or as fast as possible (False)
+replay_realtime = True
+# how boards are read: 'thread' (one polling thread per board), 'asyncio'
+# (one event loop thread reading all boards when their devices are readable)
+# or 'process' (one worker process per board, so the display can't delay
+# reading the board)
+acq_engine = 'thread'
 
 # constants
 # ~~~~~~~~~
@@ -71,64 +108,316 @@ def aqc_name(acq_info):
         afn = afn+'_tmanual'
     return afn
 
-
-# CLASS DEFINITIONS
-# create a class based on threading.thread
-class wii_thread(threading.Thread):
-    def __init__ (self,bb,cal_mod,BB_X,BB_Y):
-        threading.Thread.__init__(self)
-        self.runflag = True
-        self.storeflag = False
-        self.n_s = 4
-        self.bbdev = xwiimote.iface(bb.sys_path)
-        self.p = select.poll()
-        self.p.register(self.bbdev.get_fd(), select.POLLIN)
-        # open bb device
-        self.bbdev.open(xwiimote.IFACE_BALANCE_BOARD)
-        # create xwiimote event structure
-        self.revt = xwiimote.event()
-        # create numpy array to store data from board
-        self.tmp_dat = np.empty((1,self.n_s))
-        self.cop = np.empty((1,2))
-        self.cop_dat = np.empty((0,2))
-        self.cal_mod = cal_mod
-        self.BB_X = BB_X
-        self.BB_Y = BB_Y
-
-    def run(self):
-        lock.acquire()
-        runflag = self.runflag
-        lock.release()
-        while runflag:
-            polls = self.p.poll()
-            try:
-                self.bbdev.dispatch(self.revt)
-                tdat = self.revt.get_time()
-                for i_s in range(self.n_s):
-                    self.tmp_dat[0,i_s] = self.revt.get_abs(i_s)[0]
-                self.cop = calcCOP(self.tmp_dat,self.cal_mod,self.BB_X,self.BB_Y)
-                lock.acquire()
-                storeflag = self.storeflag
-                lock.release()
-                if storeflag:
-                    wii_q.put(np.concatenate((self.cop,np.array(tdat))))
-            except IOError as e:
-                # do nothing if resource unavailable
-                if e.errno != errno.EAGAIN:
-                    print(e)
-                    self.p.unregister(self.bbdev.get_fd())
-            lock.acquire()
-            runflag = self.runflag
-            lock.release()
-        # close down BB interface
-        self.bbdev.close(xwiimote.IFACE_BALANCE_BOARD)
-        self.p.unregister(self.bbdev.get_fd())
+def bb_label(i_bb):
+    # returns label added to file names for board number i_bb (from 0), an
+    # empty string if only one board is used
+    if n_boards == 1:
+        return ''
+    return '_bb{}'.format(i_bb+1)
+
+# function to create the writer that saves an acquisition from a board
+def make_writer(acq_info, sesh_path, s_dir_nm, i_bb, bb, cal_mod):
+    # returns unstarted writer for board number i_bb (from 0) in save_fmt
+    sfn = aqc_name(acq_info)+bb_label(i_bb)+'.'+save_fmt
+    sfn = os.path.join(sesh_path,sfn)
+    if save_fmt == 'wcop':
+        acq_meta = {'acq_info':acq_info, 'session':s_dir_nm, 'board':i_bb+1,
+            'sys_path':bb.sys_path, 'sensors':[SENS_DCT[i_s] for i_s in range(N_S)],
+            'date':datetime.now().isoformat()}
+        return wcopwriter(sfn, acq_meta, cal_mod, BB_X, BB_Y, chunk_len=buf_chunk)
+    return chunkwriter(sfn, cal_mod, BB_X, BB_Y)
+
+# function to get sensor readings for a calibration weight
+def weigh(bb, wgt):
+    # ask for weight wgt to be applied to balance board bb and return the mean
+    # reading of each sensor excluding outliers, or None if a sensor isn't
+    # taking readings
+    print('Apply',str(wgt),calib_units,'to balance board\n')
+    input_str = input('Press return when ready...\n\n')
+    # read data into preallocated array
+    sens_dat = procBBdata(bb, fillnsamp(smp_size, N_S))
+    if sens_dat.shape[0] < smp_size:
+        print('Error: only {} of {} samples read from balance board.'.format(sens_dat.shape[0],smp_size))
+        return None
+    # percentage zeros and mean excluding outliers of all sensors at once
+    prctzero, rob_mn, n_out = robuststats(sens_dat, out_thresh)
+    # for each sensor...
+    for i_s in range(N_S):
+        # print out percentage of readings == 0
+        if prctzero[i_s] > 0:
+            print('Warning: percentage zeros for {0} sensor = {1:.2f}%'.format(SENS_DCT[i_s],prctzero[i_s]))
+        # detect if all values are for sensor are zero
+        if prctzero[i_s] > maxpcnt:
+            print('Error: percentage zeros for {0} sensor exceeds maximum ({1:.2f}%).'.format(SENS_DCT[i_s],prctzero[i_s]))
+            print('Use heavier weight or move board to another location.')
+            return None
+    return rob_mn
+
+# function to calibrate a balance board
+def calibrate(bb):
+    # calibrate balance board bb using calib_wgts. Returns the calibration
+    # model cal_mod and a dictionary of the fit for each sensor, or None if a
+    # sensor isn't taking readings
+    from scipy import stats
+    # preallocate array for mean of sensor readings for each calibration weight
+    n_calib = len(calib_wgts)
+    sens_mean = np.empty([N_S,n_calib])
+    print('\n\nStarting calibration sequence...\nApply weights as close as possible to the centre...\n')
+    for i_ws in range(n_calib):
+        rob_mn = weigh(bb, calib_wgts[i_ws])
+        if rob_mn is None:
+            return None
+        sens_mean[:,i_ws] = rob_mn
+
+    # For each sensor get a linear model to calibrate data...
+    # create dictionary to store results to file and array for model parameters
+    # 'm'-slopes,'c'-intercepts, 'p'-p-values, 'r'- r values, 'se' -standard errors
+    # cal_mod row zero = slopes, row 1 = intercepts. Each col represents a sensor
+    # Calibration weights are divided by number of sensors
+    cal_mod = np.empty([2,N_S])
+    cal_dat = dict()
+    for i_s in range(N_S):
+        cal_m, cal_c, cal_r, cal_p, cal_se = stats.linregress(sens_mean[i_s,:],np.array(calib_wgts)/N_S)
+
+        # store results to dictionary
+        dc = {'m':cal_m, 'c':cal_c, 'r':cal_r, 'p':cal_p, 'se':cal_se}
+
+        # store model parameters to an array
+        cal_mod[0,i_s] = cal_m
+        cal_mod[1,i_s] = cal_c
+        cal_dat.update({SENS_DCT[i_s]:dc})
+    return cal_mod, cal_dat
+
+# function to get a stored calibration of a board that can be reused
+def cached_calibration(cache, bb_id):
+    # returns stored calibration of board bb_id from cache, or None if there
+    # isn't one within cal_valid_hrs or it used other units
+    cal = cache.get(bb_id)
+    if cal is None or cal['units'] != calib_units:
+        return None
+    if time.time() - cal['time'] > cal_valid_hrs*3600:
+        return None
+    return cal
+
+# function to check a stored calibration with a single weight
+def drift_check(bb, cal_mod):
+    # returns error of the load measured with calib_wgts[drift_wgt] as a
+    # percentage of the weight, or None if the board isn't taking readings
+    wgt = calib_wgts[drift_wgt]
+    print('\n\nChecking last calibration...\nApply weight as close as possible to the centre...\n')
+    rob_mn = weigh(bb, wgt)
+    if rob_mn is None:
+        return None
+    load = np.sum(cal_mod[0,:]*rob_mn + cal_mod[1,:])
+    return (load - wgt)/wgt*100
+
+
+# HEADLESS MODE
+# Functions to run a series of acquisitions without prompts or cop display,
+# from command line arguments or a job file, e.g.
+#   ./wiicop.py --config example.config --session Mar_01 --subject 121 \
+#       --level side=left --level trials=trial1 --time 3
+#   ./wiicop.py --job jobs.ini
+# A job file has a [session] section with config, session and optionally
+# calibration, pause and display, then one section per acquisition with
+# subject_code and the factor levels (acq_time included). Levels shared by all
+# acquisitions can go in a [DEFAULT] section. Boards use their stored
+# calibration (see cal_reuse) or the --calibration files and are kept open
+# for the whole series
+
+# function to get acquisition info from given factor levels
+def headless_acq_info(s_config, subj, levels):
+    # returns acquisition info as get_acq_info does, for subject code subj
+    # and dictionary levels of factor name to level. Factors with only one
+    # level can be left out. Raises ValueError if a level isn't valid
+    if not validcode(subj):
+        raise ValueError('Only letters and numbers for subject codes: {}'.format(subj))
+    acq_info = {'subject_code':subj}
+    for factor in s_config['factors']:
+        levs = s_config['factors'][factor].split(',')
+        lev = levels.get(factor)
+        if lev is None and len(levs) == 1:
+            lev = levs[0]
+        if lev not in levs:
+            raise ValueError('Level of {} must be one of: {}'.format(factor, ', '.join(levs)))
+        acq_info[factor] = lev
+    if not 'acq_time' in acq_info:
+        raise ValueError('There is no acq_time factor in the config file')
+    if acq_info['acq_time'] == 'inf':
+        raise ValueError('acq_time must be a number of seconds without a display')
+    unknown = set(levels) - set(acq_info)
+    if unknown:
+        raise ValueError('Unknown factors: {}'.format(', '.join(sorted(unknown))))
+    return acq_info
+
+# function to read headless options from command line arguments and job file
+def headless_args(argv):
+    # returns options and list of (subject code, levels) of each acquisition
+    import argparse
+    parser = argparse.ArgumentParser(description='Run wiicop acquisitions without prompts')
+    parser.add_argument('--job', help='job file of session options and acquisitions')
+    parser.add_argument('--config', help='name of study config file in config_files, or its path')
+    parser.add_argument('--session', help='session name, created if it does not exist')
+    parser.add_argument('--subject', help='subject code of a single acquisition')
+    parser.add_argument('--level', action='append', default=[], metavar='FACTOR=LEVEL',
+        help='level of a study factor, repeat for each factor')
+    parser.add_argument('--time', help='acquisition time in seconds (acq_time level)')
+    parser.add_argument('--calibration', nargs='+', metavar='FILE',
+        help='calibration file of each board to use instead of its stored calibration')
+    parser.add_argument('--pause', type=float, help='seconds between acquisitions')
+    parser.add_argument('--display', choices=['none','text'],
+        help='print the cop of each board every second (text) or nothing')
+    parser.add_argument('--replay', nargs='+', metavar='FILE',
+        help='.wcop recordings to replay instead of using balance boards')
+    parser.add_argument('--fast', action='store_true', help='replay as fast as possible')
+    args = parser.parse_args(argv)
+    jobs = []
+    if args.job:
+        job = configparser.ConfigParser()
+        if not job.read(args.job):
+            parser.error('cannot read job file {}'.format(args.job))
+        # command line options override those in the job file
+        if job.has_section('session'):
+            for opt in ('config','session','pause','display','calibration'):
+                if getattr(args, opt) is None and opt in job['session']:
+                    val = job['session'][opt]
+                    if opt == 'pause':
+                        val = float(val)
+                    elif opt == 'calibration':
+                        val = val.split()
+                    setattr(args, opt, val)
+        for sect in job.sections():
+            if sect == 'session':
+                continue
+            levels = dict(job[sect])
+            if not 'subject_code' in levels:
+                parser.error('no subject_code in job file section {}'.format(sect))
+            jobs.append((levels.pop('subject_code'), levels))
+    if args.subject:
+        levels = dict(lev.split('=', 1) for lev in args.level)
+        if args.time:
+            levels['acq_time'] = args.time
+        jobs.append((args.subject, levels))
+    if not args.config or not args.session or not jobs:
+        parser.error('a config, a session and at least one acquisition are needed')
+    if args.pause is None:
+        args.pause = 0
+    if args.display is None:
+        args.display = 'text'
+    return args, jobs
+
+# function to run acquisitions without prompts or display
+def run_headless(argv):
+    # argv: command line arguments, see headless_args. Returns exit status
+    args, jobs = headless_args(argv)
+    if args.replay:
+        WiiCopDevice.set_backend(WiiCopDevice.replaybackend(args.replay, not args.fast, loop=True))
+    elif replay_files:
+        WiiCopDevice.set_backend(WiiCopDevice.replaybackend(replay_files, replay_realtime, loop=True))
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    # a bare file name is a config in config_files (as chosen in the menu),
+    # anything else a path
+    cf = args.config
+    if os.path.basename(cf) == cf and os.path.isfile(os.path.join(script_dir,'config_files',cf)):
+        cf = os.path.join(script_dir,'config_files',cf)
+    config = configparser.ConfigParser()
+    if not config.read(cf):
+        print('Cannot read config file {}'.format(args.config))
+        return 1
+    # check all acquisitions before starting
+    try:
+        acq_infos = [headless_acq_info(config, subj, levels) for subj, levels in jobs]
+    except ValueError as e:
+        print(e)
+        return 1
+    # connect to balance boards
+    if n_boards == 1:
+        bb = connectBB()
+        bbs = None if bb==None else [bb]
+    else:
+        bbs = connectBBs(n_boards)
+    if bbs==None:
+        return 1
+    # session directory
+    std_dir = config['study info']['study_dir']
+    sesh_path = os.path.join(std_dir,args.session)
+    if not os.path.isdir(sesh_path):
+        os.mkdir(sesh_path,mode=0o775)
+    # calibration of each board
+    if args.calibration and len(args.calibration) != len(bbs):
+        print('{} calibration files given for {} boards'.format(len(args.calibration), len(bbs)))
+        return 1
+    cal_cache = read_calcache(os.path.join(script_dir,'calib_cache'))
+    cal_mods = []
+    for i_bb, bb in enumerate(bbs):
+        if args.calibration:
+            with open(args.calibration[i_bb],'rb') as fptr:
+                calib_dat = pickle.load(fptr)
+        else:
+            cached = cached_calibration(cal_cache, WiiCopDevice.get_backend().board_id(bb))
+            if cached is None:
+                print('No calibration of board {} from the last {} hours. Calibrate it with '
+                    'wiicop.py or use --calibration'.format(i_bb+1, cal_valid_hrs))
+                return 1
+            calib_dat = {'model':cached['model'], 'details':cached['details']}
+        cal_mods.append(calib_dat['model'])
+        cfn = os.path.join(sesh_path,'calibration'+bb_label(i_bb)+'_dat')
+        if not os.path.exists(cfn):
+            with open(cfn,'wb') as fptr:
+                pickle.dump(calib_dat,fptr)
+    # run acquisitions back to back with the boards kept open
+    t_base = time.monotonic()
+    boards = []
+    ok = True
+    for i_acq, acq_info in enumerate(acq_infos):
+        wrts = [make_writer(acq_info, sesh_path, args.session, i_bb, bb, cal_mods[i_bb])
+            for i_bb, bb in enumerate(bbs)]
+        if any(os.path.exists(wrt.fpath) for wrt in wrts):
+            print('Skipping {}: already acquired'.format(aqc_name(acq_info)))
+            continue
+        for wrt in wrts:
+            wrt.start()
+        if not boards:
+            boards = [wii_board(bb,cal_mods[i_bb],BB_X,BB_Y,wrts[i_bb],chunk_len=buf_chunk,t_base=t_base)
+                for i_bb, bb in enumerate(bbs)]
+        else:
+            for bd, wrt in zip(boards, wrts):
+                bd.set_writer(wrt)
+        print('Acquisition {} of {}: {}'.format(i_acq+1, len(acq_infos), aqc_name(acq_info)))
+        t_acq = time.monotonic()
+        def status(boards):
+            cops = ' '.join('({:6.1f},{:6.1f})'.format(*bd.latest_cop()) for bd in boards)
+            print('\r{:6.1f}s cop {}'.format(time.monotonic() - t_acq, cops), end='', flush=True)
+        ok = acquire_for(boards, float(acq_info['acq_time']),
+            status if args.display == 'text' else None)
+        if args.display == 'text':
+            print()
+        for wrt in wrts:
+            wrt.close()
+            print(wrt.fpath)
+        if not ok:
+            break
+        if args.pause > 0 and i_acq < len(acq_infos) - 1:
+            time.sleep(args.pause)
+    for bd in boards:
+        bd.close()
+    return 0 if ok else 1
+
+
+# function to import the plotting modules used by plot_cop
+def import_mpl():
+    global mpl, plt, FuncAnimation
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
 
 
+# CLASS DEFINITIONS
 class plot_cop:
     'object to implement plotting cop data in animation loop'
 
-    def __init__(self,aqc_info,BB_X,BB_Y):
+    def __init__(self,aqc_info,BB_X,BB_Y,n_bb=1,trail_len=0):
+        import_mpl()
         self.acq_info = aqc_info
         # Initial instructions
         self.text_start = 'Press Spacebar to start recording'
@@ -145,11 +434,24 @@ class plot_cop:
         ax = self.fig.add_axes([0, 0, 1, 1], frameon=False)
         ax.set_xlim(-BB_X/2, BB_X/2), ax.set_xticks([])
         ax.set_ylim(-BB_Y/2, BB_Y/2), ax.set_yticks([])
-        # create a scatter object at initial position 0,0
-        self.scat = ax.scatter(0, 0, s=200, lw=0.5, facecolors='green')
+        # create a scatter object with a dot for each board at initial position 0,0
+        self.offs = np.zeros((n_bb,2))
+        self.scat = ax.scatter(self.offs[:,0], self.offs[:,1], s=200, lw=0.5, facecolors='green')
         # create text box
         self.text_h = ax.text(0.02, 0.98, self.text_start, verticalalignment='top',horizontalalignment='left',
         transform=ax.transAxes, fontsize=12, bbox=dict(facecolor='white'), gid = 'notrec')
+        # artists redrawn each frame
+        self.artists = [self.scat, self.text_h]
+        # trailing path of the last trail_len displayed cops of the first
+        # board. Each cop is
+        # written twice, at i and i+trail_len, so the last trail_len cops are
+        # always the slice [i+1:i+1+trail_len] and nothing is allocated per frame
+        self.trail_len = trail_len
+        if trail_len > 0:
+            self.trail = np.full((2*trail_len,2), np.nan)
+            self.i_trail = 0
+            self.trail_h, = ax.plot([], [], '-', color='grey', lw=1)
+            self.artists.insert(0, self.trail_h)
         # create timer object
         if self.acq_info['acq_time'] != 'inf':
             acq_time_ms = int(self.acq_info['acq_time'])*1000
@@ -158,12 +460,40 @@ class plot_cop:
         # attach keypress event handler to figure canvas
         self.fig.canvas.mpl_connect('key_press_event', self.onkeypress)
 
+    def start_anim(self):
+        # PLOT ANIMATION - interval can't be too small or it gives an attribute error
+        self.anim = FuncAnimation(self.fig, self.animate, init_func=self.init_anim,
+            interval=anim_interval, blit=blit_f)
+
+    def init_anim(self):
+        return self.artists
+
     def animate(self,cop_i):
-        # plot COP
-        lock.acquire()
-        cop = thd.cop
-        lock.release()
-        self.scat.set_offsets(cop)
+        # plot COP of latest sample of each board
+        for i_bb, thd in enumerate(thds):
+            self.offs[i_bb,:] = thd.latest_cop()
+        self.scat.set_offsets(self.offs)
+        if self.trail_len > 0:
+            cop = self.offs[0]
+            i_t = self.i_trail
+            self.trail[i_t] = cop
+            self.trail[i_t+self.trail_len] = cop
+            self.i_trail = (i_t+1) % self.trail_len
+            trl = self.trail[self.i_trail:self.i_trail+self.trail_len]
+            self.trail_h.set_data(trl[:,0], trl[:,1])
+        self.adapt_interval()
+        return self.artists
+
+    def adapt_interval(self):
+        # double the animation interval if acquisition is falling behind the
+        # board, otherwise reduce it gradually back to anim_interval
+        timer = self.anim.event_source
+        if max(thd.event_lag() for thd in thds)*1000 > max_lag:
+            interval = min(timer.interval*2, max_interval)
+        else:
+            interval = max(int(timer.interval*0.9), anim_interval)
+        if interval != timer.interval:
+            timer.interval = interval
 
     # Keypress event handler
     def onkeypress(self,evt):
@@ -184,10 +514,8 @@ class plot_cop:
                     # manual acq
                     # change instructions
                     self.text_h.set_text(self.text_stop)
-                # set thread to store data in queue
-                lock.acquire()
-                thd.storeflag = True
-                lock.release()
+                # set threads to store data
+                self.set_flags(True, True)
 
             elif self.text_h.get_gid()=='rec':
                 # stop recording
@@ -196,21 +524,20 @@ class plot_cop:
                     pass
                 else:
                     # recording data, manual acq
-                    lock.acquire()
-                    thd.storeflag = False
-                    thd.runflag = False
-                    lock.release()
+                    self.set_flags(False, False)
                     plt.close()
             else:
                 print('error in onkeypress - unrecognised text_h gid')
 
+    def set_flags(self,storeflag,runflag):
+        # set flags of the acquisition engine of each board
+        for thd in thds:
+            thd.set_flags(storeflag, runflag)
+
     # callback function for timer
     def t_event(self):
-        # stop thread queuing data and stop it running
-        lock.acquire()
-        thd.storeflag = False
-        thd.runflag = False
-        lock.release()
+        # stop threads storing data and stop them running
+        self.set_flags(False, False)
         self.acq_timer.remove_callback(self.t_event)
         plt.close()
 
@@ -222,12 +549,25 @@ class plot_cop:
 # to suppress the annoying warning
 import warnings
 warnings.filterwarnings('ignore')
+
+# run acquisitions without prompts if options are given (see HEADLESS MODE)
+if len(sys.argv) > 1:
+    sys.exit(run_headless(sys.argv[1:]))
+
 # clear terminal
 run('clear')
 
-# connect to balance board and exit if none connected
-bb = connectBB()
-if bb==None:
+# replay recordings instead of using a real board if any are listed
+if replay_files:
+    WiiCopDevice.set_backend(WiiCopDevice.replaybackend(replay_files, replay_realtime, loop=True))
+
+# connect to balance boards and exit if not enough connected
+if n_boards == 1:
+    bb = connectBB()
+    bbs = None if bb==None else [bb]
+else:
+    bbs = connectBBs(n_boards)
+if bbs==None:
     time.sleep(5)
     print('Exiting')
     sys.exit()
@@ -286,79 +626,57 @@ sesh_path = os.path.join(std_dir,s_dir_nm)
 os.mkdir(sesh_path,mode=0o775)
 
 
-# CALIBRATE BOARD
-# ~~~~~~~~~~~~~~~
-# preallocate array for mean of sensor readings for each calibration weight
-n_calib = len(calib_wgts)
-sens_mean = np.empty([N_S,n_calib])
-print('\n\nStarting calibration sequence...\nApply weights as close as possible to the centre...\n')
-for i_ws in range(n_calib):
-    print('Apply',str(calib_wgts[i_ws]),calib_units,'to balance board\n')
-    input_str = input('Press return when ready...\n\n')
-    # read data
-    sens_dat = procBBdata(bb, getnsamp, smp_size)
-    # print(sens_dat)
-    # for each sensor...
-    for i_s in range(N_S):
-        sens_dat1 = sens_dat[:,i_s]
-        # print out percentage of readings == 0
-        prctzero = sum(sens_dat1==0)/smp_size*100
-        if prctzero > 0:
-            print('Warning: percentage zeros for {0} sensor = {1:.2f}%'.format(SENS_DCT[i_s],prctzero))
-        # detect if all values are for sensor are zero
-        if prctzero > maxpcnt:
-            print('Error: percentage zeros for {0} sensor exceeds maximum ({1:.2f}%).'.format(SENS_DCT[i_s],prctzero))
-            print('Use heavier weight or move board to another location.')
+# CALIBRATE BOARDS
+# ~~~~~~~~~~~~~~~~
+cal_mods = []
+# stored calibrations of boards
+cache_fn = os.path.join(script_dir,'calib_cache')
+cal_cache = read_calcache(cache_fn)
+for i_bb, bb in enumerate(bbs):
+    if n_boards > 1:
+        print('\n\nCalibrating board {} of {}'.format(i_bb+1, n_boards))
+    bb_id = WiiCopDevice.get_backend().board_id(bb)
+    # reuse last calibration of board if still valid
+    cal = None
+    if cal_reuse != 'never':
+        cached = cached_calibration(cal_cache, bb_id)
+        if cached is not None:
+            cal_age = (time.time() - cached['time'])/3600
+            print('Board calibrated {:.1f} hours ago'.format(cal_age))
+            if cal_reuse == 'always':
+                cal = cached['model'], cached['details']
+            else:
+                drift = drift_check(bb, cached['model'])
+                if drift is not None and abs(drift) <= drift_tol:
+                    print('Calibration error {:.2f}%, reusing last calibration'.format(drift))
+                    cal = cached['model'], cached['details']
+                elif drift is not None:
+                    print('Calibration error {:.2f}% exceeds {}%, recalibrating'.format(drift, drift_tol))
+    if cal is None:
+        cal = calibrate(bb)
+        if cal is None:
             print('Exiting')
             time.sleep(5)
             sys.exit()
-        else:
-            # get zscores for sensor
-            zscrs = stats.zscore(sens_dat1)
-            # replace those outside threshold with nans
-            sens_dat1[np.absolute(zscrs) > out_thresh] = np.nan
-            # get mean excluding nans.
-            sens_mean[i_s,i_ws] = np.nanmean(sens_dat1)
-
-# For each sensor get a linear model to calibrate data...
-# create dictionary to store results to file and array for model parameters
-# 'm'-slopes,'c'-intercepts, 'p'-p-values, 'r'- r values, 'se' -standard errors
-# cal_mod row zero = slopes, row 1 = intercepts. Each col represents a sensor
-# Calibration weights are divided by number of sensors
-cal_mod = np.empty([2,N_S])
-cal_dat = dict()
-dc = dict()
-for i_s in range(N_S):
-    cal_m, cal_c, cal_r, cal_p, cal_se = stats.linregress(sens_mean[i_s,:],calib_wgts.values/N_S)
-
-    # store results to dictionary
-    dc.update({'m':cal_m})
-    dc.update({'c':cal_c})
-    dc.update({'r':cal_r})
-    dc.update({'p':cal_p})
-    dc.update({'se':cal_se})
-
-    # store model parameters to an array
-    cal_mod[0,i_s] = cal_m
-    cal_mod[1,i_s] = cal_c
-    cal_dat.update({SENS_DCT[i_s]:dc})
-
-# save calibration data in session directory
-calib_dat = {'model':cal_mod, 'details':cal_dat}
-cfn = os.path.join(sesh_path,'calibration_dat')
-with open(cfn,'wb') as fptr:
-    pickle.dump(calib_dat,fptr)
-print('Remove calibration weights from balance board\n\n')
+        write_calcache(cache_fn, bb_id, cal[0], cal[1], calib_units)
+    cal_mod, cal_dat = cal
+    cal_mods.append(cal_mod)
+    # save calibration data in session directory
+    calib_dat = {'model':cal_mod, 'details':cal_dat}
+    cfn = os.path.join(sesh_path,'calibration'+bb_label(i_bb)+'_dat')
+    with open(cfn,'wb') as fptr:
+        pickle.dump(calib_dat,fptr)
+    print('Remove calibration weights from balance board\n\n')
 
 # #TEST overide calibration
 # cal_mod = np.array([[0.01776906,0.01645395,0.02366412,0.02252513],[ 0.39208467,-0.7261971,-0.05245845,-3.55288195]])
 
 # GET SERIES OF ACQUISITIONS
 loop_flag = True
-
-# set up objects for data acquisition
-lock = threading.Lock()
-wii_q = Queue(maxsize=0)
+# event loop shared by the acquisition engines of all boards
+if acq_engine == 'asyncio':
+    acq_loop = asyncloop()
+    acq_loop.start()
 
 
 while loop_flag:
@@ -368,34 +686,43 @@ while loop_flag:
     acq_info = get_acq_info(config)
 
     # create plot_cop instance
-    pltcop_obj = plot_cop(acq_info,BB_X,BB_Y)
-    thd = wii_thread(bb,cal_mod,BB_X,BB_Y)
+    pltcop_obj = plot_cop(acq_info,BB_X,BB_Y,n_boards,trail_len)
+    # time zero of time base shared by all boards
+    t_base = time.monotonic()
+    # for each board get save file name, start writer and create thread...
+    wrts = []
+    thds = []
+    for i_bb, bb in enumerate(bbs):
+        wrt = make_writer(acq_info, sesh_path, s_dir_nm, i_bb, bb, cal_mods[i_bb])
+        wrts.append(wrt)
+        if acq_engine == 'process':
+            # writer is started and closed by the worker process
+            thds.append(wii_process(bb,cal_mods[i_bb],BB_X,BB_Y,wrt,chunk_len=buf_chunk,
+                t_base=t_base))
+            continue
+        wrt.start()
+        if acq_engine == 'asyncio':
+            thds.append(wii_async(bb,cal_mods[i_bb],BB_X,BB_Y,wrt,acq_loop.loop,chunk_len=buf_chunk,
+                t_base=t_base))
+        else:
+            thds.append(wii_thread(bb,cal_mods[i_bb],BB_X,BB_Y,wrt,chunk_len=buf_chunk,t_base=t_base))
 
-    # Start thread
-    thd.start()
+    # Start threads
+    for thd in thds:
+        thd.start()
 
-    # PLOT ANIMATION - interval can't be too small or it gives an attribute error
-    animation = FuncAnimation(pltcop_obj.fig, pltcop_obj.animate,interval=anim_interval)
+    # plot animation
+    pltcop_obj.start_anim()
     plt.show()
 
-    thd.join()
-
-    # get data from queue and write to file
-    acq_data = np.empty((0,4))
-    while not(wii_q.empty()):
-        acq_data = np.vstack((acq_data,wii_q.get()))
-    # convert 3rd (secs) & 4th (microsecs) col to 1 col of secs
-    acq_data[:,2] = acq_data[:,2] + acq_data[:,3]/1000000
-    # convert to pandas dataframe
-    acq_dat_df = pd.DataFrame(data=acq_data[:,(0,1,2)],columns=('copx','copy','time'))
-    # subtract the time of the first reading from the others - start a time=o
-    acq_dat_df['time'] = acq_dat_df['time'] - acq_dat_df.ix[0,'time']
-    # write to file...
-    # get save file name...
-    sfn = aqc_name(acq_info)+'.csv'
-    sfn = os.path.join(sesh_path,sfn)
-    print(sfn)
-    acq_dat_df.to_csv(sfn,index=False)
+    for thd in thds:
+        thd.join()
+
+    # write remaining data and finalize files
+    for wrt in wrts:
+        if acq_engine != 'process':
+            wrt.close()
+        print(wrt.fpath)
 
     # ask user if they wish to do another acquisition
     chc = input('Get another acquisition? (y/n)\n')
@@ -408,4 +735,7 @@ while loop_flag:
         # clear terminal
         # run('clear')
 
+if acq_engine == 'asyncio':
+    acq_loop.stop()
+
 # END OF ACQUISITION LOOP